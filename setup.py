@@ -2,7 +2,7 @@
 """Setup script."""
 
 import os
-from distutils.core import setup
+from setuptools import setup
 
 
 def read(*rnames):
@@ -53,4 +53,10 @@ setup(
         'webtest'
     ],
     zip_safe=False,
+    entry_points={
+        'console_scripts': [
+            'zojax-migration-manifest = zojax.gae.migration.manifest:main',
+            'zojax-migration-run = zojax.gae.migration.runner:main',
+        ],
+    },
 )
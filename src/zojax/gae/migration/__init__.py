@@ -1,4 +1,5 @@
 # Python package.
 
-from migrate import register_migrations, read_migrations, Migration
+from migrate import register_migrations, read_migrations, clear_migrations_cache, Migration
+from scheduler import DependencyError
 
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from itertools import count
+
+try:
+    import ndb
+except ImportError: # pragma: no cover
+    from google.appengine.ext import ndb
+
+from google.appengine.api import apiproxy_stub_map
+
+from .stats import Recorder, record_writes
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# attributes of a migration a dry run changes
+_RUN_STATE = ('dry_run', 'sharding', 'checkpoints', 'deadline', 'sample_batches', 'count_limit',
+              'direction', 'step_index', 'sample')
+
+
+class DryRunWriteError(Exception):
+    """
+    Raised when a datastore write bypasses ndb during a dry run.
+    """
+    pass
+
+
+def _pre_call_hook(service, call, request, response):
+    if getattr(_local, 'active', False) and call in ('Put', 'Delete'):
+        raise DryRunWriteError("Datastore %s is not allowed in a dry run" % call)
+
+
+class DryRunContext(ndb.Context):
+    """
+    ndb context which records puts and deletes instead of sending them to
+
+    the datastore. Batches are recorded as the Put or Delete RPC the
+
+    autobatcher would send. Put entities without complete keys get fake ids.
+    """
+
+    _ids = count(1)
+
+    @ndb.tasklet
+    def _put_tasklet(self, todo, options):
+        record_writes(len(todo), 'Put')
+        for future, entity in todo:
+            key = entity._key
+            if key is None or key.id() is None:
+                key = ndb.Key(entity._get_kind(), self._ids.next(),
+                              parent=key.parent() if key is not None else None)
+                entity._key = key
+            future.set_result(key)
+
+    @ndb.tasklet
+    def _delete_tasklet(self, todo, options):
+        record_writes(len(todo), 'Delete')
+        for future, key in todo:
+            future.set_result(None)
+
+
+def dry_run(migration, direction, sample_batches=1, count_limit=100000):
+    """
+    Runs the steps of ``migration`` for ``direction`` without committing
+
+    anything and returns a cost report. Mapped steps process at most
+
+    ``sample_batches`` batches and are extrapolated to the number of
+
+    entities of their query (counted up to ``count_limit``). The state of
+
+    ``migration`` is restored afterwards.
+    """
+    saved = dict((name, migration.__dict__[name]) for name in _RUN_STATE
+                 if name in migration.__dict__)
+    try:
+        return _dry_run(migration, direction, sample_batches, count_limit)
+    finally:
+        for name in _RUN_STATE:
+            if name in saved:
+                setattr(migration, name, saved[name])
+            else:
+                migration.__dict__.pop(name, None)
+
+
+def _dry_run(migration, direction, sample_batches, count_limit):
+    migration.dry_run = True
+    migration.sharding = False
+    migration.checkpoints = False
+    migration.deadline = None
+    migration.sample_batches = sample_batches
+    migration.count_limit = count_limit
+    migration.direction = direction
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'zojax.gae.migration.dryrun', _pre_call_hook, 'datastore_v3')
+
+    estimated = {'rpcs': 0, 'reads': 0, 'writes': 0, 'duration': 0.0}
+    steps = []
+    context = ndb.get_context()
+    ndb.set_context(DryRunContext())
+    _local.active = True
+    try:
+        for index, step in enumerate(migration.get_sequence(direction)):
+            migration.step_index = index
+            migration.sample = None
+            report = {'step': index}
+            with Recorder() as recorder:
+                try:
+                    getattr(step, direction)(migration=migration)
+                except Exception, err:
+                    logger.exception("Dry run of step %d of %s failed", index, migration.id)
+                    report['error'] = "%s: %s" % (err.__class__.__name__, err)
+            report.update(recorder.as_dict())
+
+            processed, total = migration.sample or (None, None)
+            scale = float(total) / processed if processed else 1.0
+            report['sampled'] = processed
+            report['total'] = total
+            report['estimated'] = dict((name, report[name] * scale) for name in estimated)
+            for name in estimated:
+                estimated[name] += report['estimated'][name]
+            steps.append(report)
+            if 'error' in report:
+                break
+    finally:
+        _local.active = False
+        ndb.set_context(context)
+
+    return {'application': migration.application,
+            'migration': migration.id,
+            'direction': direction,
+            'steps': steps,
+            'estimated': estimated,
+            }
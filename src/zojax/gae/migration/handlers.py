@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import json
+import pstats
 import webapp2, ndb
 import logging
 
@@ -10,8 +13,12 @@ from webapp2_extras import jinja2
 from google.appengine.ext import db
 from google.appengine.api import taskqueue
 
-from .migrate import default_config, MigrationEntry
-from .migrate import read_migrations, MigrationList, call_next, get_migration_dirs
+from .migrate import default_config, MigrationEntry, MigrationProfile, MigrationRun, CHAIN_PARAMS, MIGRATION_STATUSES
+from .migrate import get_status_etag, get_progress, progress_report, MigrationLease, _enqueue
+from .migrate import configure_tasks
+from .dryrun import dry_run as run_dry
+from .scheduler import DependencyError, blockers, check_cycles, start_all
+from .migrate import read_migrations, MigrationList, call_next, get_migration_dirs, migrations_left
 
 
 
@@ -31,9 +38,72 @@ class BaseHandler(webapp2.RequestHandler):
                         #user_values=config
                         )
         self.migration_model = self.config.get("migration_model", MigrationEntry)
+        configure_tasks(self.config)
 
-        self.migrations = read_migrations(get_migration_dirs())
+    @webapp2.cached_property
+    def migrations(self):
+        # Parsed migrations are cached process-wide by read_migrations.
+        return read_migrations(get_migration_dirs(),
+                               lazy=self.config.get("lazy_migrations", True))
 
+    @webapp2.cached_property
+    def chain_params(self):
+        # parameters passed along to all tasks of the migration chain
+        return dict((name, self.request.get(name)) for name in CHAIN_PARAMS
+                    if self.request.get(name))
+
+    def renew_lease(self, application):
+        """
+        Renews the run lease of the chain of the task, returns False if
+
+        another chain holds it. Tasks queued without a chain are not leased.
+        """
+        chain = self.chain_params.get("chain")
+        if chain and not MigrationLease.renew(application, chain, self.config.get("lease_ttl")):
+            logging.warning("Dropping a task of chain %s, migrations of %s are processed by another chain",
+                            chain, application)
+            return False
+        return True
+
+    def release_lease(self, application):
+        chain = self.chain_params.get("chain")
+        if chain:
+            MigrationLease.release(application, chain)
+
+    def find_migration(self, application, id):
+        for migration in self.migrations.get(application, []):
+            if migration.id == id:
+                return migration
+
+    def get_progress(self, application, statuses, entries=None):
+        """
+        Returns a dict of ids of migrations of ``application`` in process to
+
+        their ``progress_report``. Progress is read from the memcache counters,
+
+        or from the entries (``entries`` dict of ids, fetched if not given)
+
+        when the counters were evicted.
+        """
+        running = [(id, status.split()[0]) for id, status in statuses.items()
+                   if status.endswith("in process")]
+        if not running:
+            return {}
+        progress = dict((id, value) for (id, direction), value in
+                        get_progress(self.migration_model, application, running).items())
+
+        missing = [id for id, direction in running if id not in progress]
+        if entries is None and missing:
+            keys = [self.migration_model.key_for(application, id) for id in missing]
+            entries = dict(zip(missing, ndb.get_multi(keys)))
+        for id in missing:
+            entry = entries.get(id)
+            if entry is not None and entry.progress_started is not None:
+                progress[id] = {"done": entry.progress_done,
+                                "total": entry.progress_total,
+                                "started": entry.progress_started}
+
+        return dict((id, progress_report(**value)) for id, value in progress.items())
 
     @webapp2.cached_property
     def jinja2(self):
@@ -61,11 +131,131 @@ class MigrationHandler(BaseHandler):
                                             "migrate.html")).read())
 
     def get(self):
+        application = self.request.get("app")
+        status = self.request.get("status")
+        try:
+            page = max(int(self.request.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+        page_size = self.config.get("admin_page_size", 50)
+
+        rows = [row for row in self.get_rows(application)
+                if not status or row["status"] == status]
+        pages = max((len(rows) + page_size - 1) // page_size, 1)
+        page = min(page, pages)
+        page_rows = rows[(page - 1) * page_size:page * page_size]
+        self.load_rows(page_rows)
+
         self.render_response(self.template, **{
-                                                "entities": self.migrations,
+                                                "rows": page_rows,
+                                                "applications": sorted(self.migrations.keys()),
+                                                "statuses": MIGRATION_STATUSES,
+                                                "application": application,
+                                                "status": status,
+                                                "page": page,
+                                                "pages": pages,
+                                                "total": len(rows),
                                                 })
         return
 
+    def get_rows(self, application=None):
+        """
+        Returns a row dict for every migration (of ``application``) with its
+
+        status, served from the status snapshots without reading entries.
+        """
+        rows = []
+        for app in sorted(self.migrations.keys()):
+            if application and app != application:
+                continue
+            migrations = self.migrations[app]
+            statuses = migrations.statuses()
+            for index, migration in enumerate(migrations):
+                rows.append({"app": app,
+                             "migration": migration,
+                             "status": statuses[migration.id],
+                             "apply": migrations.url_query_for("apply", migration, index),
+                             "rollback": migrations.url_query_for("rollback", migration, index),
+                             "dryrun": migrations.url_query_for("dryrun", migration, index),
+                             })
+        return rows
+
+    def load_rows(self, rows):
+        """
+        Adds entries, step metrics and progress to ``rows`` of the page, the
+
+        entries are fetched with a single get_multi along with the last runs
+
+        of migrations without an entry, e.g. rolled back ones.
+        """
+        keys = []
+        for row in rows:
+            key = row["migration"].key
+            keys.append(key)
+            if row["status"] == "new":
+                keys.extend(MigrationRun.key_for(key, direction) for direction in ("apply", "rollback"))
+        fetched = dict(zip(keys, ndb.get_multi(keys)))
+        for row in rows:
+            key = row["migration"].key
+            entry = row["entry"] = fetched[key]
+            row["steps"] = entry.metrics if entry is not None else []
+            row["profiles"] = entry.profiles if entry is not None else 0
+            if entry is None and row["status"] == "new":
+                run = MigrationRun.last([fetched[MigrationRun.key_for(key, direction)]
+                                         for direction in ("apply", "rollback")])
+                if run is not None:
+                    row["steps"] = run.metrics
+                    row["profiles"] = run.profiles
+
+        for app in set(row["app"] for row in rows):
+            app_rows = [row for row in rows if row["app"] == app]
+            progress = self.get_progress(app,
+                                         dict((row["migration"].id, row["status"]) for row in app_rows),
+                                         dict((row["migration"].id, row["entry"]) for row in app_rows))
+            for row in app_rows:
+                row["progress"] = progress.get(row["migration"].id)
+
+
+class MigrationStatusAPI(BaseHandler):
+    """
+    Responds with the statuses of the migrations of every application (or
+
+    of ``app``) as JSON. Statuses come from the memcache snapshots, polls with
+
+    a matching If-None-Match get 304 without reading them.
+    """
+
+    def get(self):
+        application = self.request.get("app")
+        migrations = self.migrations
+        if application:
+            if application not in migrations:
+                self.abort(404)
+            migrations = {application: migrations[application]}
+
+        etag = get_status_etag(self.migration_model, migrations)
+        self.response.headers["Cache-Control"] = "no-cache"
+        if etag is not None:
+            self.response.etag = etag
+            if etag in self.request.if_none_match:
+                self.response.status = 304
+                return
+
+        result = {}
+        for app, app_migrations in migrations.items():
+            statuses = app_migrations.statuses()
+            progress = self.get_progress(app, statuses)
+            result[app] = {
+                "total": len(app_migrations),
+                "applied": len([m for m in app_migrations if statuses[m.id] == "apply success"]),
+                "migrations": [{"id": m.id, "status": statuses[m.id]} for m in app_migrations],
+            }
+            for migration in result[app]["migrations"]:
+                if migration["id"] in progress:
+                    migration["progress"] = progress[migration["id"]]
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(result, indent=2))
+
 
 class QueueHandler(BaseHandler):
     """
@@ -78,14 +268,78 @@ class QueueHandler(BaseHandler):
         target_index = self.request.GET.get("index", None)
         application = self.request.GET.get("app")
 
-        call_next(self.migrations, application, target_index, action, self.uri_for("migration_worker"))
+        if action == "dryrun":
+            return self.dry_run(application, target_index)
+
+        if self.request.GET.get("all"):
+            return self.start_all(action)
+
+        try:
+            check_cycles(self.migrations)
+        except DependencyError, e:
+            self.response.status = 400
+            self.response.write(str(e))
+            return
+
+        chain = MigrationLease.new_chain()
+        lease = MigrationLease.acquire(application, chain, self.config.get("lease_ttl"),
+                                       action, target_index)
+        if lease.chain != chain:
+            if (lease.action, lease.target_index) == (action, target_index):
+                # a repeated request joins the running chain
+                return self.redirect_to("migration")
+            self.response.status = 409
+            self.response.write("Migrations of %s are being processed by another chain" % application)
+            return
+
+        call_next(self.migrations, application, target_index, action, self.uri_for("migration_worker"),
+                  dict(self.chain_params, chain=chain))
 
         self.redirect_to("migration")
 
         return
 
 
+    def start_all(self, action):
+        """
+        Starts parallel chains applying or rolling back all applications.
+        """
+        if action not in ("apply", "rollback"):
+            self.abort(400)
+        try:
+            start_all(self.migrations, action, self.uri_for("migration_worker"),
+                      self.config.get("lease_ttl"), self.chain_params)
+        except DependencyError, e:
+            self.response.status = 400
+            self.response.write(str(e))
+            return
+        self.redirect_to("migration")
+
+    def dry_run(self, application, index):
+        """
+        Responds with the cost report of a dry run of the migration.
+        """
+        try:
+            migration = self.migrations[application][int(index)]
+        except (ValueError, TypeError, IndexError, KeyError):
+            self.abort(404)
+
+        direction = self.request.GET.get("direction", "apply")
+        if direction not in ("apply", "rollback"):
+            self.abort(400)
+
+        report = run_dry(migration, direction, self.config.get("dry_run_batches"),
+                         self.config.get("dry_run_count_limit"))
+        self.response.content_type = "application/json"
+        self.response.write(json.dumps(report, indent=2))
+
+
 class MigrationWorker(BaseHandler):
+    """
+    Applies or rolls back migrations of the chain until the task budget or
+
+    the number of migrations per task runs out, then starts the next task.
+    """
 
     def post(self):
         application = self.request.get('application')
@@ -96,6 +350,9 @@ class MigrationWorker(BaseHandler):
         if not action or not index or not target_index or not application:
             return
 
+        if not self.renew_lease(application):
+            return
+
         try:
             migrations = self.migrations[application]
             migration = migrations[int(index)]
@@ -103,12 +360,153 @@ class MigrationWorker(BaseHandler):
             migration = None
             migrations = []
 
-        if migration is not None:
+        deadline = time.time() + self.config.get("task_budget")
+        processed = 0
+        while migration is not None:
             migration.target_index = target_index
+            migration.deadline = deadline
+            migration.inline = True
+            migration.chain_params = self.chain_params
+            migration.profile = migration.profile or bool(self.chain_params.get("profile"))
+            try:
+                blocking = blockers(self.migrations, migration, action)
+            except DependencyError, e:
+                logging.error("Stopping %s of %s: %s", action, migration.id, e)
+                self.release_lease(application)
+                break
+            if blocking:
+                self.hold(migration, action, blocking)
+                break
             getattr(migration, action)()
+            processed += 1
+            if migration.finished is None:
+                # failed, continued in another task or nothing to do
+                if migration.status.endswith("failed") or \
+                        not migrations_left(self.migrations, application, target_index, action):
+                    self.release_lease(application)
+                break
+            # migrations waiting for other ones as well are started in named tasks
+            index = call_next(self.migrations, application, target_index, action,
+                              self.uri_for("migration_worker"), self.chain_params, after=migration,
+                              inline=not migration.out_of_time() and
+                                     processed < self.config.get("task_migrations"))
+            if index is None:
+                break
+            migration = migrations[index]
+
+
+    def hold(self, migration, action, blocking):
+        """
+        Polls until the ``blocking`` migrations of other applications are
+
+        done. Stops the chain if they failed or no chain is running them.
+        """
+        for other, status in blocking:
+            if status.endswith("failed") or MigrationLease.holder(other.application) is None:
+                logging.error("Stopping %s of %s: %s of %s is %s", action, migration.id,
+                              other.id, other.application, status)
+                self.release_lease(migration.application)
+                return
+        logging.info("Holding %s of %s for %s", action, migration.id,
+                     ", ".join("%s:%s" % (other.application, other.id) for other, status in blocking))
+        params = dict(self.chain_params)
+        params.update({'index': self.migrations[migration.application].index(migration),
+                       'action': action,
+                       'application': migration.application,
+                       'target_index': migration.target_index,
+                       })
+        _enqueue(self.uri_for("migration_worker"), params, countdown=self.config.get("hold_countdown"))
+
+
+class MigrationShardWorker(BaseHandler):
+    """
+    Maps a key range of a sharded migration step.
+    """
+
+    def post(self):
+        application = self.request.get('application')
+        action = self.request.get('action')
+        shard = self.request.get('shard')
+        start = self.request.get('start')
+        end = self.request.get('end')
+        cursor = self.request.get('cursor')
+
+        if action not in ("apply", "rollback") or not shard or not application:
+            return
+
+        if not self.renew_lease(application):
+            return
+
+        migration = self.find_migration(application, self.request.get('id'))
+
+        if migration is not None:
+            migration.target_index = self.request.get('target_index')
+            migration.chain_params = self.chain_params
+            migration.profile = migration.profile or bool(self.chain_params.get("profile"))
+            migration.deadline = time.time() + self.config.get("task_budget")
+            migration.run_shard(action, shard,
+                                start=ndb.Key(urlsafe=start) if start else None,
+                                end=ndb.Key(urlsafe=end) if end else None,
+                                cursor=cursor or None)
+            if migration.status.endswith("failed"):
+                self.release_lease(application)
+
+
+class MigrationProfileHandler(BaseHandler):
+    """
+    Lists profiles of a migration, shows the top functions of a profile or
+
+    downloads it in pstats format (format=pstats).
+    """
+
+    def get(self):
+        migration = self.find_migration(self.request.get('app'), self.request.get('id'))
+        if migration is None:
+            self.abort(404)
+
+        self.response.content_type = "text/plain"
+        profile_id = self.request.get('profile')
+        if not profile_id:
+            # sorted here, an ancestor query with a sort order needs a composite index
+            profiles = MigrationProfile.query(ancestor=migration.key).fetch()
+            profiles.sort(key=lambda profile: profile.created, reverse=True)
+            for profile in profiles[:100]:
+                self.response.write("%s?app=%s&id=%s&profile=%s\n" % (
+                    self.uri_for("migration_profile"), migration.application,
+                    migration.id, profile.key.id()))
+            return
+
+        sort = self.request.get('sort', 'cumulative')
+        try:
+            profile_id = int(profile_id)
+            top = int(self.request.get('top', 30))
+        except ValueError:
+            self.abort(400)
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            self.abort(400)
+
+        profile = ndb.Key(MigrationProfile, profile_id, parent=migration.key).get()
+        if profile is None:
+            self.abort(404)
+
+        if self.request.get('format') == 'pstats':
+            self.response.content_type = "application/octet-stream"
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename="%s-%s.pstats"' % (migration.id, profile_id)
+            self.response.write(profile.data)
+            return
+
+        stats = profile.get_stats(stream=self.response.out)
+        stats.sort_stats(sort)
+        stats.print_stats(top)
 
 
 class MigrationStatus(BaseHandler):
+    """
+    Applies status changes queued by earlier versions, statuses are now
+
+    changed synchronously with Migration.transition.
+    """
 
     def post(self):
 
@@ -118,14 +516,13 @@ class MigrationStatus(BaseHandler):
         except (ValueError, TypeError):
             id = None
 
-        migration_object = self.migration_model.get_by_id(id)
-
-        if migration_object:
-            if status == "rollback success": # we can entirely remove the migration entry
-                #logging.info("MigrationStatus: removing migration_object %s " % str(migration_object))
-                migration_object.key.delete()
-                return
+        # tasks carry the automatic id of the entry, it may have been re-keyed since
+        migration_object = self.migration_model.get_by_id(id) if id else None
+        if migration_object is None and id:
+            migration_object = self.migration_model.query(self.migration_model.legacy_id == id).get()
 
-            migration_object.status = status
-            migration_object.put()
-            #logging.info("MigrationStatus: put migration_object %s " % str(migration_object))
\ No newline at end of file
+        if migration_object and status in MIGRATION_STATUSES[1:]:
+            self.migration_model.rekey_legacy(migration_object.application,
+                                              force=migration_object.legacy_id is None)
+            self.migration_model.transition(migration_object.application, migration_object.id,
+                                            None, status)
\ No newline at end of file
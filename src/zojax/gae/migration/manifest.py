@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Writes the manifests of registered migration directories at build time:
+
+    zojax-migration-manifest myapp.models otherapp.models
+
+Modules given on the command line are imported to register their
+
+migrations with ``register_migrations``.
+"""
+
+import os
+import re
+import sys
+import json
+import optparse
+
+from .migrate import MANIFEST_NAME, MANIFEST_VERSION, get_migration_dirs, read_migrations
+from .migrate import _list_migration_dir, _read_source, _read_metadata, write_code_cache
+from .scheduler import DependencyError, check_cycles
+
+
+class ManifestError(Exception):
+    """
+    Raised for migration directories with duplicate or misordered ids.
+    """
+    pass
+
+
+def build_manifest(dir):
+    """
+    Returns the manifest of migration directory ``dir``: ordered files with
+
+    their ids, hashes, metadata, whether they are post-apply hooks, and
+
+    sizes telling whether they changed since.
+    """
+    files = []
+    for path in _list_migration_dir(dir):
+        id = os.path.splitext(os.path.basename(path))[0]
+        source, hash = _read_source(path)
+        files.append({'file': os.path.basename(path),
+                      'id': id,
+                      'hash': hash,
+                      'size': os.stat(path).st_size,
+                      'post_apply': id.startswith('post-apply'),
+                      'metadata': _read_metadata(path),
+                      })
+    return {'version': MANIFEST_VERSION, 'files': files}
+
+
+def check_manifest(manifest):
+    """
+    Returns a list of problems of a manifest: migrations with the same
+
+    number, or numbered in another order than their names sort in.
+    """
+    problems = []
+    numbers = {}
+    previous = None
+    for described in manifest['files']:
+        if described['post_apply']:
+            continue
+        match = re.match(r'\d+', described['id'])
+        if match is None:
+            continue
+        number = int(match.group())
+        if number in numbers:
+            problems.append("%s and %s have the same number" % (numbers[number], described['id']))
+        elif previous is not None and number < previous[0]:
+            problems.append("%s is applied after %s" % (described['id'], previous[1]))
+        numbers[number] = described['id']
+        previous = (number, described['id'])
+    return problems
+
+
+def check_directories(directories=None):
+    """
+    Returns ``(dir, manifest)`` pairs of ``directories`` (a set of
+
+    ``(app_name, path)``, the registered ones by default). Raises
+
+    ManifestError listing the problems of the directories and circular
+
+    dependencies of the migrations.
+    """
+    directories = get_migration_dirs() if directories is None else directories
+    problems = []
+    manifests = []
+    for app_name, dir in sorted(directories):
+        manifest = build_manifest(dir)
+        problems.extend("%s: %s" % (app_name, problem) for problem in check_manifest(manifest))
+        manifests.append((dir, manifest))
+    try:
+        check_cycles(read_migrations(directories, lazy=True, manifests=False))
+    except DependencyError, e:
+        problems.append(str(e))
+    if problems:
+        raise ManifestError("\n".join(problems))
+    return manifests
+
+
+def write_manifests(directories=None, compile=False):
+    """
+    Checks and writes the manifests of ``directories``, compiling the
+
+    migration files first if ``compile`` is True. Nothing is written if a
+
+    directory has problems. Returns the paths of the written manifests.
+    """
+    manifests = check_directories(directories)
+    if compile:
+        write_code_cache(get_migration_dirs() if directories is None else directories)
+    written = []
+    for dir, manifest in manifests:
+        path = os.path.join(dir, MANIFEST_NAME)
+        file = open(path, 'w')
+        try:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        finally:
+            file.close()
+        written.append(path)
+    return written
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] module...",
+                                   description="Writes the manifests of the migration directories "
+                                               "registered by the given modules.")
+    parser.add_option("--compile", action="store_true", default=False,
+                      help="compile the migration files as well")
+    parser.add_option("--check", action="store_true", default=False,
+                      help="only check the migration directories")
+    options, modules = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    for module in modules:
+        __import__(module)
+    if not get_migration_dirs():
+        parser.error("no migration directories are registered")
+
+    try:
+        if options.check:
+            check_directories()
+        else:
+            for path in write_manifests(compile=options.compile):
+                print path
+    except ManifestError, e:
+        print >> sys.stderr, e
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+
+try:
+    import ndb
+except ImportError: # pragma: no cover
+    from google.appengine.ext import ndb
+
+from google.appengine.api import datastore_errors
+
+
+logger = logging.getLogger(__name__)
+
+# datastore errors telling the datastore is overloaded or entities are contended
+CONTENTION_ERRORS = (datastore_errors.Timeout, datastore_errors.TransactionFailedError)
+
+
+class Mapper(object):
+    """
+    Applies ``fn`` to every entity of ``query``, paging through the query
+
+    with cursors and writing results in batches.
+
+    ``fn`` receives an entity and returns what should be written: an entity
+
+    (or a list of entities) to put, a key (or a list of keys) to delete, or
+
+    None when nothing has to be written. ``fn`` may be a tasklet.
+
+    With ``shards`` greater than 1 the key space of the query is split into
+
+    ranges mapped by parallel tasks. Such queries should have neither
+
+    inequality filters nor sort orders.
+
+    With ``throttle`` (a Throttle, or True for the default one) batches are
+
+    written slower while the datastore is slow or contended.
+    """
+
+    def __init__(self, query, fn, batch_size=100, shards=1, throttle=None):
+        assert batch_size > 0, "batch_size should be positive"
+        assert shards > 0, "shards should be positive"
+        self.query = query
+        self.fn = fn
+        self.batch_size = batch_size
+        self.shards = shards
+        self.throttle = Throttle() if throttle is True else throttle
+
+    def get_query(self):
+        """
+        Returns the query to map, ``query`` may be a callable returning it.
+        """
+        if isinstance(self.query, ndb.Query):
+            return self.query
+        return self.query()
+
+    def __call__(self, migration):
+        if self.shards > 1 and migration is not None and migration.sharding:
+            ranges = split_key_ranges(self.get_query(), self.shards)
+            if len(ranges) > 1:
+                return migration.fan_out(ranges)
+        return self.run_async(migration, cursor=migration.cursor if migration is not None else None)
+
+    def run(self, migration, cursor=None, start=None, end=None):
+        """
+        Maps entities of the query, optionally limited to the key range [start, end).
+
+        Starts from urlsafe ``cursor`` if given. The cursor of every written
+
+        batch is saved with ``migration.checkpoint``. When the migration is
+
+        out of time the mapping continues in a new task.
+        """
+        self.run_async(migration, cursor=cursor, start=start, end=end).get_result()
+
+    @ndb.tasklet
+    def run_async(self, migration, cursor=None, start=None, end=None):
+        """
+        Asynchronous ``run``. The next page is fetched and the previous batch
+
+        is written while the current batch is mapped.
+        """
+        query = self.get_query()
+        if start is not None:
+            query = query.filter(ndb.query.FilterNode('__key__', '>=', start))
+        if end is not None:
+            query = query.filter(ndb.query.FilterNode('__key__', '<', end))
+
+        if cursor:
+            cursor = ndb.Cursor(urlsafe=cursor)
+        fetch = query.fetch_page_async(self.batch_size, start_cursor=cursor or None)
+        writes = []
+        written = None # cursor after the batch being written
+        batches = processed = 0
+        while fetch is not None:
+            entities, cursor, more = yield fetch
+            batches += 1
+            processed += len(entities)
+            if migration is not None and migration.dry_run and batches > migration.sample_batches:
+                # the sample is extrapolated to the whole query
+                total = yield query.count_async(limit=migration.count_limit)
+                migration.sample = (processed - len(entities), total)
+                break
+            if written is not None and migration is not None and migration.out_of_time():
+                if writes:
+                    yield writes
+                    self.checkpoint(migration, written)
+                migration.continue_later()
+            fetch = query.fetch_page_async(self.batch_size, start_cursor=cursor) if more else None
+            to_put, to_delete = yield self.map_async(entities)
+            if migration is not None:
+                migration.progress(len(entities))
+            if writes:
+                yield writes
+                self.checkpoint(migration, written)
+            if self.throttle is not None and self.throttle.delay:
+                yield ndb.sleep(self.throttle.delay)
+            writes = self.write_async(to_put, to_delete)
+            written = cursor
+        if writes:
+            yield writes
+
+    def checkpoint(self, migration, cursor):
+        if migration is not None and cursor is not None:
+            migration.cursor = cursor.urlsafe()
+            migration.checkpoint(migration.step_index, migration.cursor)
+
+    @ndb.tasklet
+    def map_async(self, entities):
+        """
+        Maps a batch of entities, returns ``(to_put, to_delete)`` lists.
+        """
+        results = []
+        if entities:
+            results = yield [as_future(self.fn(entity)) for entity in entities]
+
+        to_put = []
+        to_delete = []
+        for result in results:
+            if result is None:
+                continue
+            if not isinstance(result, (list, tuple)):
+                result = [result]
+            for item in result:
+                if isinstance(item, ndb.Key):
+                    to_delete.append(item)
+                else:
+                    to_put.append(item)
+        raise ndb.Return((to_put, to_delete))
+
+    def write_async(self, to_put, to_delete):
+        """
+        Starts writing a mapped batch, returns a list of futures. With a
+
+        throttle the batch is timed and rewritten after contention errors.
+        """
+        if self.throttle is not None:
+            return [self.throttled_write_async(to_put, to_delete)]
+        futures = []
+        if to_put:
+            futures.extend(ndb.put_multi_async(to_put))
+        if to_delete:
+            futures.extend(ndb.delete_multi_async(to_delete))
+        return futures
+
+    @ndb.tasklet
+    def throttled_write_async(self, to_put, to_delete):
+        """
+        Writes a mapped batch, reporting its latency or contention errors to
+
+        the throttle. A failed batch is written again after the throttle delay,
+
+        ``throttle.retries`` times. Ids of new entities are allocated first, so
+
+        the batch writes the same entities each time even if a failed attempt
+
+        was committed.
+        """
+        throttle = self.throttle
+        if to_put:
+            yield complete_keys_async(to_put)
+        for attempt in range(throttle.retries + 1):
+            started = time.time()
+            futures = []
+            if to_put:
+                futures.extend(ndb.put_multi_async(to_put))
+            if to_delete:
+                futures.extend(ndb.delete_multi_async(to_delete))
+            try:
+                yield futures
+            except CONTENTION_ERRORS, e:
+                throttle.contended()
+                if attempt == throttle.retries:
+                    raise
+                logger.warning("Writing a batch failed with %r, retrying in %.1fs", e, throttle.delay)
+                yield ndb.sleep(throttle.delay)
+            else:
+                throttle.observe(time.time() - started)
+                return
+
+
+class Throttle(object):
+    """
+    Adapts the pause before every written batch of a mapper to the datastore
+
+    load, additive increase / multiplicative decrease style: the pause is
+
+    multiplied by ``factor`` (and at least ``step``) when a batch takes
+
+    longer than ``target_latency`` seconds to write or fails with a
+
+    contention error, and shortened by ``step`` when a batch is written
+
+    faster, down to no pause at all. The pause never exceeds ``max_delay``.
+    """
+
+    def __init__(self, target_latency=0.5, step=0.1, factor=2.0, max_delay=30.0, retries=3):
+        assert target_latency > 0, "target_latency should be positive"
+        assert factor > 1, "factor should be greater than 1"
+        self.target_latency = target_latency
+        self.step = step
+        self.factor = factor
+        self.max_delay = max_delay
+        self.retries = retries
+        self.delay = 0.0
+
+    def observe(self, latency):
+        """
+        Records the ``latency`` of a written batch.
+        """
+        if latency > self.target_latency:
+            self.slow_down()
+        else:
+            self.speed_up()
+
+    def contended(self):
+        """
+        Records a batch failed with a contention error.
+        """
+        self.slow_down()
+
+    def slow_down(self):
+        self.delay = min(self.max_delay, max(self.step, self.delay * self.factor))
+
+    def speed_up(self):
+        self.delay = max(0.0, round(self.delay - self.step, 6))
+
+
+def as_future(result):
+    """
+    Returns ``result`` if it is a future, otherwise a future resolved to it.
+    """
+    if isinstance(result, ndb.Future):
+        return result
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+@ndb.tasklet
+def complete_keys_async(entities):
+    """
+    Gives ``entities`` without a key or with an incomplete one keys with
+
+    allocated ids, one allocate_ids call per kind and parent.
+    """
+    groups = {}
+    for entity in entities:
+        key = entity.key
+        if key is None:
+            key = ndb.Key(entity._get_kind(), None)
+        if key.id() is None:
+            groups.setdefault(key, []).append(entity)
+    if not groups:
+        return
+    groups = groups.items()
+    ranges = yield [ndb.get_context().allocate_ids(key, size=len(group)) for key, group in groups]
+    for (key, group), (start, end) in zip(groups, ranges):
+        for entity, id in zip(group, range(start, end + 1)):
+            entity.key = ndb.Key(key.kind(), id, parent=key.parent(),
+                                 app=key.app(), namespace=key.namespace())
+
+
+def split_key_ranges(query, shards, oversampling=32):
+    """
+    Splits the key space of ``query`` kind into at most ``shards`` ranges
+
+    of similar size, using the __scatter__ property sample. Returns a list
+
+    of ``(start, end)`` key pairs, None stands for an open end.
+    """
+    sample_query = ndb.Query(kind=query.kind, namespace=query.namespace)
+    sample_query = sample_query.order(ndb.GenericProperty('__scatter__'))
+    keys = sorted(sample_query.fetch(shards * oversampling, keys_only=True))
+
+    points = []
+    for n in range(1, shards):
+        if not keys:
+            break
+        point = keys[len(keys) * n // shards]
+        if point not in points:
+            points.append(point)
+
+    bounds = [None] + points + [None]
+    return zip(bounds[:-1], bounds[1:])
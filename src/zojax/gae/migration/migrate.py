@@ -2,7 +2,19 @@
 
 import os
 
+import ast
+import imp
+import json
 import urllib
+import marshal
+import cProfile
+import pstats
+import hashlib
+import random
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
 
 ######################
 #PATCH FOR ndb IMPORT#
@@ -35,9 +47,37 @@ from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
 
 from .utils import plural
+from .mapper import Mapper, as_future
+from .dryrun import dry_run as run_dry
+from .stats import Recorder, add_recorded
 
 
 _MIGRATION_DIRS = set([])
+# dependency specs of registered applications
+_APP_DEPENDS = {}
+# "kind/application" of entries of earlier versions known to be re-keyed
+_REKEYED = set()
+
+WORKER_URL = '/_ah/migration/tasks/worker/'
+SHARD_URL = '/_ah/migration/tasks/shard/'
+
+# request parameters passed along to all tasks of a migration chain
+CHAIN_PARAMS = ('profile', 'chain')
+
+# module level variables of migration files read as migration metadata
+METADATA = ('profile', 'depends')
+
+# memcache counters the progress of a migration is spread over
+PROGRESS_SHARDS = 16
+
+# whether compiled migration files are shared between instances through memcache
+CODE_CACHE_MEMCACHE = True
+# extension of compiled migration files written by write_code_cache
+CODE_CACHE_EXTENSION = '.code'
+
+# file name and format version of the manifest of a migration directory
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 3
 
 def get_migration_dirs():
     """
@@ -48,46 +88,287 @@ def get_migration_dirs():
     return _MIGRATION_DIRS
 
 
-def call_next(migrations, application, target_index, action, worker_url):
+def call_next(migrations, application, target_index, action, worker_url, params=None,
+              after=None, inline=False):
     """
-    Calculates index of the next migration and starts it.
+    Calculates indexes of the next migrations and starts them.
         * migrations - MigrationList instance, list of all migrations;
         * target_index - index of the target migration from the migrations list;
         * application - application name used in migrations list;
         * action - apply|rollback;
         * worker_url - url of the migration handler;
+        * params - CHAIN_PARAMS passed along to the tasks;
+        * after - migration just processed, only migrations waiting for it are started;
+        * inline - whether the caller runs a migration waiting only for ``after`` itself;
+
+    Returns the index of the migration the caller should run inline, if any.
+
+    Tasks of a chain are named, so a migration waiting for several ones is
+
+    started once.
+    """
+    indexes = ready_migration_indexes(migrations, application, target_index, action, after)
+    chain = params.get('chain') if params else None
+    if not indexes:
+        if chain and (after is None or not migrations_left(migrations, application, target_index, action)):
+            # the chain is complete, or has nothing to start with
+            MigrationLease.release(application, chain)
+        return None
+
+    app_migrations = migrations[application]
+    inline_index = None
+    if inline and after is not None:
+        for index in indexes:
+            waits_for = _waits_for(app_migrations, app_migrations[index], action)
+            if [m.id for m in waits_for] == [after.id]:
+                inline_index = index
+                break
+
+    for index in indexes:
+        if index == inline_index:
+            continue
+        task_params = dict(params or {})
+        task_params.update({'index': index,
+                            'action': action,
+                            'application': application,
+                            'target_index': target_index
+                            })
+        name = None
+        if chain:
+            name = "%s-%s-%s" % (chain, action, hashlib.md5(
+                "%s/%s" % (application, app_migrations[index].id)).hexdigest())
+        _enqueue(worker_url, task_params, name=name)
+    return inline_index
+
+
+def next_migration_index(migrations, application, target_index, action):
+    """
+    Returns index of the next migration to apply or rollback on the way to
+
+    the target migration, None if there's nothing left. Arguments are the
+
+    same as for ``call_next``.
+    """
+    indexes = ready_migration_indexes(migrations, application, target_index, action)
+    if indexes:
+        return indexes[0]
 
 
+def ready_migration_indexes(migrations, application, target_index, action, after=None):
+    """
+    Returns indexes of the migrations ready to apply or rollback on the way
+
+    to the target migration: migrations whose prerequisites in the application
+
+    are applied or, for rollbacks, whose dependents are rolled back. With
+
+    ``after`` only migrations waiting for it are returned. Rollbacks are
+
+    returned in reverse order.
     """
     assert isinstance(migrations, dict), "migrations should be a dict"
     assert application, "application should not be empty"
     assert isinstance(target_index, (basestring, int)) or target_index is None, "target_index should be int, str or None"
     assert action in ("apply", "rollback"), "action should be apply or rollback"
 
-    target_migrations = target_migration = origin_migrations = None
-    if isinstance(target_index, basestring) and len(target_index):
-        target_index = int(target_index)
+    app_migrations = migrations.get(application)
+    targets = _target_migrations(app_migrations, target_index, action)
+    if not targets:
+        return []
+    statuses = app_migrations.statuses()
+
+    graph = _dependency_graph(app_migrations)
+
+    if after is not None:
+        # ``after`` may come from another read of the migrations
+        related = graph['dependents'] if action == "apply" else graph['prerequisites']
+        target_ids = set(m.id for m in targets)
+        candidates = [m for m in related.get(after.id, []) if m.id in target_ids]
+    else:
+        candidates = targets
+    todo = "new" if action == "apply" else "apply success"
+
+    ready = []
+    for migration in candidates:
+        if statuses[migration.id] != todo:
+            continue
+        if any(_blocks(app_migrations, statuses, migration, other, action)
+               for other in _waits_for(app_migrations, migration, action)):
+            continue
+        ready.append(graph['index'][migration.id])
+    return sorted(ready, reverse=action == "rollback")
+
+
+def migrations_left(migrations, application, target_index, action):
+    """
+    Returns True while migrations on the way to the target migration are
+
+    left to process or are being processed.
+    """
+    app_migrations = migrations.get(application)
+    targets = _target_migrations(app_migrations, target_index, action)
+    if not targets:
+        return False
+    statuses = app_migrations.statuses()
+    todo = "new" if action == "apply" else "apply success"
+    return any(statuses[m.id] == todo or statuses[m.id].endswith("in process") for m in targets)
+
+
+def app_prerequisites(app_migrations, migration):
+    """
+    Returns migrations of the application of ``migration`` it depends on:
+
+    the ones of the application named by the ``depends`` variable of its
+
+    file, or the previous migration if the file has no ``depends`` or names
+
+    migrations of other applications only.
+    """
+    return list(_dependency_graph(app_migrations)['prerequisites'][migration.id])
+
+
+def app_dependents(app_migrations, migration):
+    """
+    Returns migrations of the application of ``migration`` depending on it.
+    """
+    return list(_dependency_graph(app_migrations)['dependents'][migration.id])
+
+
+def find_migration(app_migrations, id):
+    """
+    Returns the migration ``id`` (with or without the .py extension), or None.
+    """
+    if id.endswith(".py"):
+        id = id[:-3]
+    for migration in app_migrations:
+        if migration.id in (id, id + ".py"):
+            return migration
+
+
+def _own_specs(migration):
+    # ids of the migrations of its own application ``depends`` of ``migration`` names
+    for spec in migration.depends:
+        app, sep, id = spec.partition(":")
+        if not sep:
+            yield spec
+        elif app == migration.application:
+            yield id
+
+
+def _dependency_graph(app_migrations):
+    # prerequisites, dependents and indexes of migrations of an application by
+    # their ids, built once per list of migrations
+    signature = [(migration.id, id(migration)) for migration in app_migrations]
+    cached = getattr(app_migrations, '_graph', None)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    by_id = dict((migration.id, migration) for migration in app_migrations)
+    graph = {'index': dict((migration.id, index) for index, migration in enumerate(app_migrations)),
+             'prerequisites': {},
+             'dependents': dict((migration.id, []) for migration in app_migrations),
+             # migrations depending on the previous one only because nothing else is named
+             'implicit': set(),
+             }
+    for index, migration in enumerate(app_migrations):
+        prerequisites = []
+        if migration.depends is not None:
+            for spec in _own_specs(migration):
+                if spec.endswith(".py"):
+                    spec = spec[:-3]
+                prerequisite = by_id.get(spec) or by_id.get(spec + ".py")
+                if prerequisite is not None and prerequisite not in prerequisites:
+                    prerequisites.append(prerequisite)
+        if migration.depends is None or (migration.depends and not prerequisites):
+            graph['implicit'].add(migration.id)
+            prerequisites = [app_migrations[index - 1]] if index else []
+        graph['prerequisites'][migration.id] = prerequisites
+        for prerequisite in prerequisites:
+            graph['dependents'][prerequisite.id].append(migration)
 
     try:
-        origin_migrations = migrations[application]
-        target_migration = origin_migrations[target_index]
-    except (ValueError, IndexError, KeyError, TypeError):
+        app_migrations._graph = (signature, graph)
+    except AttributeError:
         pass
-    if target_migration is not None and target_index is not None and len(origin_migrations):
-        if action == "apply":
-            target_migrations = origin_migrations[:target_index+1].to_apply()
-        elif action == "rollback":
-            target_migrations = origin_migrations[target_index:].to_rollback()
+    return graph
+
+
+def _target_migrations(app_migrations, target_index, action):
+    # migrations up to (from, for rollbacks) the target and the ones they depend on
+    try:
+        target_index = int(target_index)
+        app_migrations[target_index]
+    except (ValueError, IndexError, TypeError):
+        return []
+    graph = _dependency_graph(app_migrations)
+    if action == "apply":
+        targets, follow = list(app_migrations[:target_index + 1]), graph['prerequisites']
+    else:
+        targets, follow = list(app_migrations[target_index:]), graph['dependents']
+    seen = set(migration.id for migration in targets)
+    for migration in targets:
+        for other in follow[migration.id]:
+            if other.id not in seen:
+                seen.add(other.id)
+                targets.append(other)
+    return targets
+
+
+def _waits_for(app_migrations, migration, action):
+    if action == "apply":
+        return app_prerequisites(app_migrations, migration)
+    return app_dependents(app_migrations, migration)
+
+
+def _blocks(app_migrations, statuses, migration, other, action):
+    # whether ``other`` has to be processed before ``migration``
+    status = statuses[other.id]
+    if action == "rollback":
+        return status == "apply success" or status.endswith("in process")
+    if migration.id not in _dependency_graph(app_migrations)['implicit']:
+        return status != "apply success"
+    # the previous migration only has to be processed, as before dependencies
+    return status == "new" or status.endswith("in process")
+
+
+# queue, target and retry options of migration tasks, see ``configure_tasks``
+_TASK_OPTIONS = {}
+
+
+def configure_tasks(config):
+    """
+    Sets the options migration tasks are added with from ``config`` (see
+
+    ``default_config``): the ``queue_name``, the ``task_target`` version or
+
+    module, and ``task_retry``, a dict of ``taskqueue.TaskRetryOptions``.
+    """
+    options = {'queue_name': config.get('queue_name') or 'default'}
+    if config.get('task_target'):
+        options['target'] = config['task_target']
+    if config.get('task_retry'):
+        options['retry_options'] = taskqueue.TaskRetryOptions(**config['task_retry'])
+    _TASK_OPTIONS.clear()
+    _TASK_OPTIONS.update(options)
+
+
+def _enqueue(url, params, countdown=None, name=None):
+    """
+    Adds a migration task, once for a ``name``.
+    """
+    try:
+        taskqueue.add(url=url, params=params, countdown=countdown, name=name, **_TASK_OPTIONS)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logger.info("Task %s has already been added", name)
 
-        if target_migrations:
-            index = origin_migrations.index(target_migrations[0])
 
-            taskqueue.add(url=worker_url,
-                params={'index': index,
-                        'action': action,
-                        'application': application,
-                        'target_index': target_index
-                })
+class StepDeferred(Exception):
+    """
+    Raised by a step which continues in other tasks. Stops processing of
+
+    the migration steps without failing or succeeding the migration.
+    """
+    pass
 
 
 class AlreadyRegisteredError(Exception):
@@ -97,180 +378,1215 @@ class AlreadyRegisteredError(Exception):
     pass
 
 
-def register_migrations(app_name, migrations_path="migrations"):
+def register_migrations(app_name, migrations_path="migrations", depends=None):
     """
     Registers migrations directory for given app_name. Usually called
 
     from models.py module of application.
 
-    Raises AlreadyRegisteredError when already registered application or
+    ``depends`` lists applications ("app") or migrations ("app:id") of
+
+    other applications all migrations of the application depend on.
+
+    Raises AlreadyRegisteredError when already registered application or
+
+    migrations path occurs.
+
+    """
+
+    cur_path = os.path.dirname(sys._getframe(1).f_globals["__file__"])
+
+    global _MIGRATION_DIRS
+
+    abs_path = os.path.normpath(os.path.abspath(
+                                    os.path.join(cur_path, migrations_path)
+                                ))
+    valid_appname = app_name.strip()
+
+    for known_app, known_path in _MIGRATION_DIRS:
+        if valid_appname == known_app:
+            raise AlreadyRegisteredError("Application '%s' has already been registered" % valid_appname)
+        if abs_path == known_path:
+            raise AlreadyRegisteredError("Migration directory '%s' has already been registered for '%s' application" % (abs_path, known_app))
+
+    _MIGRATION_DIRS.add((valid_appname, abs_path))
+    if depends:
+        _APP_DEPENDS[valid_appname] = list(depends)
+
+
+def get_app_dependencies():
+    """
+    Returns a dict of registered applications to their dependency specs.
+    """
+    return _APP_DEPENDS
+
+
+
+def _status_generation_key(migration_model, application):
+    return "%s:generation:%s" % (migration_model._get_kind(), application)
+
+
+def _progress_generation_key(migration_model, application):
+    return "%s:progress_generation:%s" % (migration_model._get_kind(), application)
+
+
+def get_status_generation(migration_model, application):
+    """
+    Returns current generation of the status snapshot of ``application``,
+
+    or None when memcache is unavailable.
+    """
+    return _get_generation(_status_generation_key(migration_model, application))
+
+
+def get_progress_generation(migration_model, application):
+    """
+    Returns current generation of the stored progress of ``application``,
+
+    or None when memcache is unavailable.
+    """
+    return _get_generation(_progress_generation_key(migration_model, application))
+
+
+def _get_generation(key):
+    generation = memcache.get(key)
+    if generation is None:
+        # a time based start never reuses snapshots of an evicted generation
+        memcache.add(key, int(time.time() * 1000))
+        generation = memcache.get(key)
+    return generation
+
+
+def get_status_etag(migration_model, migrations):
+    """
+    Returns an ETag of the statuses of ``migrations``, a dict of application
+
+    names to MigrationList, derived from the status generations and the
+
+    migration files. Returns None when memcache is unavailable.
+    """
+    digest = hashlib.md5()
+    for application in sorted(migrations):
+        generation = get_status_generation(migration_model, application)
+        if generation is None:
+            return None
+        digest.update("%s:%s:%s\n" % (application, generation,
+                                       get_progress_generation(migration_model, application)))
+        for migration in migrations[application]:
+            digest.update("%s:%s\n" % (migration.id, migration.hash))
+    return digest.hexdigest()
+
+
+def invalidate_statuses(migration_model, application):
+    """
+    Invalidates the status snapshot of ``application`` by moving to the next generation.
+    """
+    memcache.incr(_status_generation_key(migration_model, application),
+                  initial_value=int(time.time() * 1000))
+
+
+def invalidate_progress(migration_model, application):
+    """
+    Moves the stored progress of ``application`` to the next generation.
+    """
+    memcache.incr(_progress_generation_key(migration_model, application),
+                  initial_value=int(time.time() * 1000))
+
+
+def get_statuses(migration_model, application, ids):
+    """
+    Returns a dict of migration ``ids`` of ``application`` to their statuses.
+
+    Statuses are served from the memcache snapshot of the application, only
+
+    migrations missing from the snapshot are fetched from the datastore.
+    """
+    generation = get_status_generation(migration_model, application)
+    snapshot_key = "%s:statuses:%s:%s" % (migration_model._get_kind(), application, generation)
+    snapshot = (memcache.get(snapshot_key) if generation is not None else None) or {}
+
+    missing = [id for id in ids if id not in snapshot]
+    if missing:
+        if migration_model.rekey_legacy(application):
+            snapshot = {}
+            missing = list(ids)
+        entries = model.get_multi([migration_model.key_for(application, id) for id in missing])
+        for id, entry in zip(missing, entries):
+            snapshot[id] = entry.status if entry is not None else "new"
+        if generation is not None:
+            memcache.set(snapshot_key, snapshot)
+
+    return dict((id, snapshot[id]) for id in ids)
+
+
+def _progress_key(migration_model, application, id, direction):
+    return "%s:progress:%s:%s:%s" % (migration_model._get_kind(), application, id, direction)
+
+
+def _progress_keys(base):
+    return [base + ":total", base + ":started"] + \
+        ["%s:%d" % (base, shard) for shard in range(PROGRESS_SHARDS)]
+
+
+def get_progress(migration_model, application, migrations):
+    """
+    Returns a dict of ``(id, direction)`` pairs of running ``migrations`` of
+
+    ``application`` to their progress dicts (done, total and started), read
+
+    from the memcache counters with a single get_multi. Migrations without
+
+    counters are left out.
+    """
+    bases = dict((migration, _progress_key(migration_model, application, *migration))
+                 for migration in migrations)
+    values = memcache.get_multi([key for base in bases.values() for key in _progress_keys(base)])
+    progress = {}
+    for migration, base in bases.items():
+        started = values.get(base + ":started")
+        if started is None:
+            continue
+        progress[migration] = {
+            "done": sum(values.get("%s:%d" % (base, shard), 0) for shard in range(PROGRESS_SHARDS)),
+            "total": values.get(base + ":total"),
+            "started": started,
+        }
+    return progress
+
+
+def reset_progress(migration_model, application, id, direction):
+    """
+    Removes the progress counters of migration ``id`` of ``application``.
+    """
+    memcache.delete_multi(_progress_keys(_progress_key(migration_model, application, id, direction)))
+
+
+def progress_report(done, total, started, now=None):
+    """
+    Returns a dict of ``done`` of ``total`` items processed since ``started``
+
+    with the percent, throughput (items per second) and estimated seconds
+
+    left. Percent and estimate are None while the total is unknown.
+    """
+    elapsed = max((now or time.time()) - started, 0.001)
+    rate = done / elapsed
+    report = {"done": done, "total": total, "rate": rate, "percent": None, "eta": None}
+    if total:
+        report["percent"] = min(100.0 * done / total, 100.0)
+        if rate:
+            report["eta"] = max(total - done, 0) / rate
+    return report
+
+
+class StepMetrics(model.Model):
+    """
+    Performance of a processed migration step, summed over the tasks it ran in.
+    """
+    step = model.IntegerProperty()
+    direction = model.StringProperty()
+    started = model.DateTimeProperty()
+    finished = model.DateTimeProperty()
+    duration = model.FloatProperty(default=0.0)
+    rpcs = model.IntegerProperty(default=0)
+    reads = model.IntegerProperty(default=0)
+    writes = model.IntegerProperty(default=0)
+    # times the step was resumed in a new task
+    retries = model.IntegerProperty(default=0)
+
+
+def _add_metrics(known_metrics, metrics):
+    # adds ``metrics`` to the ones of the same step and direction in ``known_metrics``
+    for known in known_metrics:
+        if known.step == metrics.step and known.direction == metrics.direction:
+            known.finished = max(known.finished, metrics.finished)
+            known.duration += metrics.duration
+            known.rpcs += metrics.rpcs
+            known.reads += metrics.reads
+            known.writes += metrics.writes
+            known.retries += metrics.retries
+            return
+    known_metrics.append(metrics)
+
+
+class RekeyMarker(model.Model):
+    """
+    Marks an application whose entries of earlier versions have been moved
+
+    to deterministic keys, keyed by "kind/application".
+    """
+    created = model.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def _cache_key(cls, marker):
+        return "%s:%s" % (cls._get_kind(), marker)
+
+
+class MigrationRun(model.Model):
+    """
+    Step metrics of the last finished run of a migration in a direction,
+
+    child of its MigrationEntry keyed by the direction. Runs are kept when a
+
+    rollback removes the entry.
+    """
+    finished = model.DateTimeProperty(auto_now_add=True)
+    direction = model.StringProperty()
+    status = model.StringProperty()
+    metrics = model.LocalStructuredProperty(StepMetrics, repeated=True)
+    # profiles of the migration, counted on the run once the entry is removed
+    profiles = model.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, entry_key, direction):
+        """
+        Returns the key of the last run in ``direction`` of the migration
+
+        entry ``entry_key``.
+        """
+        return model.Key(cls, direction, parent=entry_key)
+
+    @staticmethod
+    def last(runs):
+        """
+        Returns the run of ``runs`` finished last, None if there are none.
+        """
+        runs = [run for run in runs if run is not None]
+        return max(runs, key=lambda run: run.finished) if runs else None
+
+
+class MigrationProfile(model.Model):
+    """
+    cProfile statistics of a profiled migration run, child of its MigrationEntry.
+    """
+    created = model.DateTimeProperty(auto_now_add=True)
+    direction = model.StringProperty()
+    # marshalled pstats data, as written by pstats.Stats.dump_stats
+    data = model.BlobProperty(compressed=True)
+
+    def get_stats(self, stream=None):
+        """
+        Returns ``pstats.Stats`` of the profile printing to ``stream``.
+        """
+        return pstats.Stats(_StatsDump(self.data), stream=stream)
+
+
+class _StatsDump(object):
+    """
+    Marshalled pstats data in the form ``pstats.Stats`` loads profiles from.
+    """
+
+    def __init__(self, data):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+# "new" migrations have no MigrationEntry
+MIGRATION_STATUSES = ["new",
+                      "apply in process",
+                      "rollback in process",
+                      "apply failed",
+                      "rollback failed",
+                      "apply success",
+                      "rollback success",
+                      ]
+
+
+class MigrationEntry(model.Model):
+    """
+    Represents Migration in storage.
+    """
+    id = model.StringProperty()
+    application = model.StringProperty()
+    ctime = model.DateTimeProperty(auto_now_add=True)
+
+    status = model.StringProperty(required=True, choices=MIGRATION_STATUSES[1:])
+    # shards of the sharded step still being mapped, as "step/shard"
+    pending_shards = model.StringProperty(repeated=True, indexed=False)
+    # checkpoint: index of the next step to process and cursor of the mapped query
+    step = model.IntegerProperty(default=0, indexed=False)
+    cursor = model.StringProperty(indexed=False)
+    metrics = model.LocalStructuredProperty(StepMetrics, repeated=True)
+    profiles = model.IntegerProperty(default=0, indexed=False)
+    # progress counters last flushed from memcache
+    progress_done = model.IntegerProperty(default=0, indexed=False)
+    progress_total = model.IntegerProperty(indexed=False)
+    progress_started = model.FloatProperty(indexed=False)
+    # automatic id of the entry created by earlier versions, see ``rekey_legacy``
+    legacy_id = model.IntegerProperty()
+
+    @classmethod
+    def key_for(cls, application, id):
+        """
+        Returns deterministic key of the entry for migration ``id`` of ``application``.
+        """
+        return model.Key(cls, "%s/%s" % (application, id))
+
+    @classmethod
+    def rekey_legacy(cls, application, force=False):
+        """
+        Moves entries of ``application`` that earlier versions stored under
+
+        automatic ids to their deterministic keys, once per application unless
+
+        ``force`` is True: a RekeyMarker is stored afterwards. Returns True if
+
+        entries were moved.
+        """
+        marker = "%s/%s" % (cls._get_kind(), application)
+        if not force:
+            if marker in _REKEYED:
+                return False
+            if memcache.get(RekeyMarker._cache_key(marker)) or RekeyMarker.get_by_id(marker) is not None:
+                memcache.set(RekeyMarker._cache_key(marker), True)
+                _REKEYED.add(marker)
+                return False
+        moved = False
+        keys = [key for key in cls.query(cls.application == application).fetch(keys_only=True)
+                if isinstance(key.id(), (int, long))]
+        for entry in model.get_multi(keys):
+            if entry is None:
+                continue
+            key = cls.key_for(application, entry.id)
+
+            def txn():
+                if key.get() is None and entry.status != "rollback success":
+                    cls(key=key, id=entry.id, application=application, ctime=entry.ctime,
+                        status=entry.status, legacy_id=entry.key.id()).put()
+
+            ndb.transaction(txn)
+            entry.key.delete()
+            moved = True
+        RekeyMarker(id=marker).put()
+        memcache.set(RekeyMarker._cache_key(marker), True)
+        _REKEYED.add(marker)
+        if moved:
+            invalidate_statuses(cls, application)
+        return moved
+
+    @classmethod
+    def transition(cls, application, id, from_status, to_status):
+        """
+        Transactionally changes the status of migration ``id`` of ``application``
+
+        from ``from_status`` (a status, a tuple of statuses or None for any) to
+
+        ``to_status``. A missing entry has status "new", "rollback success"
+
+        removes the entry. Returns True if the transition took place.
+        """
+        if isinstance(from_status, basestring):
+            from_status = (from_status,)
+        if not ndb.in_transaction():
+            cls.rekey_legacy(application)
+        key = cls.key_for(application, id)
+
+        def txn():
+            entry = key.get()
+            status = entry.status if entry is not None else "new"
+            if from_status is not None and status not in from_status:
+                return False
+            if status.endswith("in process") and not to_status.endswith("in process"):
+                # metrics of the run outlive the entry
+                direction = status.split()[0]
+                MigrationRun(key=MigrationRun.key_for(key, direction), direction=direction,
+                             status=to_status, profiles=entry.profiles,
+                             metrics=[m for m in entry.metrics if m.direction == direction]).put()
+            if to_status == "rollback success":
+                if entry is not None:
+                    key.delete()
+            elif entry is None:
+                # profiles of earlier runs outlive the entry as well
+                profiles = MigrationProfile.query(ancestor=key).count()
+                cls(key=key, id=id, application=application, status=to_status, profiles=profiles).put()
+            else:
+                if to_status.endswith("in process"):
+                    entry.step = 0
+                    entry.cursor = None
+                    # metrics of earlier runs are kept by their MigrationRun
+                    entry.metrics = [m for m in entry.metrics if m.direction != to_status.split()[0]]
+                    entry.progress_done = 0
+                    entry.progress_total = entry.progress_started = None
+                entry.status = to_status
+                entry.put()
+            return True
+
+        def committed():
+            # hooks could run before the commit, so invalidate once more
+            invalidate_statuses(cls, application)
+            if to_status.endswith("in process"):
+                reset_progress(cls, application, id, to_status.split()[0])
+
+        # steps wrapped in a transaction change the status within it
+        if ndb.in_transaction():
+            changed = txn()
+            if changed:
+                # statuses read before the outer transaction commits are stale
+                ndb.get_context().call_on_commit(committed)
+        else:
+            changed = ndb.transaction(txn)
+            if changed:
+                committed()
+        return changed
+
+    @classmethod
+    def checkpoint(cls, application, id, step=None, cursor=None, metrics=None):
+        """
+        Saves the position of migration ``id`` of ``application`` being in
+
+        process, and adds ``metrics`` of a step to the entry. Metrics of the
+
+        step finishing the migration are added to its MigrationRun as well.
+        """
+        key = cls.key_for(application, id)
+
+        def txn():
+            entry = key.get()
+            changed = []
+            if entry is not None:
+                if step is not None and entry.status.endswith("in process"):
+                    entry.step = step
+                    entry.cursor = cursor
+                    changed.append(entry)
+                if metrics is not None:
+                    entry.add_metrics(metrics)
+                    if entry not in changed:
+                        changed.append(entry)
+                # statuses snapshot doesn't change
+                entry._checkpoint_only = True
+            if metrics is not None and (entry is None or not entry.status.endswith("in process")):
+                # the step called succeed(), the run is stored (and a rollback removed the entry)
+                run = MigrationRun.key_for(key, metrics.direction).get()
+                if run is not None:
+                    _add_metrics(run.metrics, metrics)
+                    changed.append(run)
+            if changed:
+                model.put_multi(changed)
+
+        txn() if ndb.in_transaction() else ndb.transaction(txn, retries=10)
+
+    def add_metrics(self, metrics):
+        """
+        Adds ``metrics`` to the metrics of the same step and direction.
+        """
+        _add_metrics(self.metrics, metrics)
+
+    @classmethod
+    def set_progress(cls, application, id, done, total, started):
+        """
+        Stores progress counters of migration ``id`` of ``application`` being
+
+        in process. The done count never decreases, e.g. when memcache
+
+        counters were evicted.
+        """
+        key = cls.key_for(application, id)
+
+        def txn():
+            entry = key.get()
+            if entry is None or not entry.status.endswith("in process"):
+                return
+            entry.progress_done = max(entry.progress_done or 0, done)
+            if total is not None:
+                entry.progress_total = total
+            if entry.progress_started is None:
+                entry.progress_started = started
+            entry._checkpoint_only = True
+            entry.put()
+
+        ndb.transaction(txn, retries=10)
+        invalidate_progress(cls, application)
+
+    @classmethod
+    def add_profile(cls, application, id, direction, profiler):
+        """
+        Stores statistics of ``profiler`` as a MigrationProfile of migration
+
+        ``id`` of ``application``. Returns the profile key.
+        """
+        profiler.create_stats()
+        key = cls.key_for(application, id)
+        profile = MigrationProfile(parent=key, direction=direction,
+                                   data=marshal.dumps(profiler.stats))
+
+        def txn():
+            entry = key.get()
+            if entry is None:
+                # a rollback removed the entry, the profile is counted on its run
+                run = MigrationRun.key_for(key, direction).get()
+                if run is None:
+                    return profile.put()
+                run.profiles += 1
+                return model.put_multi([profile, run])[0]
+            entry.profiles += 1
+            entry._checkpoint_only = True
+            return model.put_multi([profile, entry])[0]
+
+        return ndb.transaction(txn, retries=10)
+
+    @classmethod
+    def start_shards(cls, application, id, step, shards):
+        """
+        Saves ``step`` of migration ``id`` of ``application`` as the next step
+
+        to process along with its pending ``shards``, in one transaction.
+        """
+        key = cls.key_for(application, id)
+
+        def txn():
+            entry = key.get()
+            entry.step = step
+            entry.cursor = None
+            entry.pending_shards = shards
+            entry._checkpoint_only = True
+            entry.put()
+
+        txn() if ndb.in_transaction() else ndb.transaction(txn, retries=10)
+
+    @classmethod
+    def finish_shard(cls, application, id, shard, metrics=None):
+        """
+        Marks ``shard`` of migration ``id`` of ``application`` as finished
+
+        and adds its ``metrics``. Returns True only for the call finishing
+
+        the last pending shard.
+        """
+        key = cls.key_for(application, id)
+
+        def txn():
+            entry = key.get()
+            if entry is None or shard not in entry.pending_shards:
+                return False
+            entry.pending_shards.remove(shard)
+            if metrics is not None:
+                entry.add_metrics(metrics)
+            entry.put()
+            return not entry.pending_shards
+
+        return ndb.transaction(txn, retries=10)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(MigrationEntry, cls)._post_delete_hook(key, future)
+        if isinstance(key.id(), basestring):
+            invalidate_statuses(cls, key.id().rsplit("/", 1)[0])
+
+    def _post_put_hook(self, future):
+        super(MigrationEntry, self)._post_put_hook(future)
+        if not getattr(self, '_checkpoint_only', False):
+            invalidate_statuses(self.__class__, self.application)
+
+default_config = {
+    'migration_model':  MigrationEntry,
+    'lazy_migrations': True,
+    # seconds a worker task runs steps before continuing in a new task
+    'task_budget': 480,
+    # migrations a worker task applies or rolls back before starting a new task
+    'task_migrations': 50,
+    # batches of every mapped step a dry run processes before extrapolating
+    'dry_run_batches': 1,
+    # entities counted at most to extrapolate a dry run
+    'dry_run_count_limit': 100000,
+    # migrations listed per page of the admin page
+    'admin_page_size': 50,
+    # seconds the run lease of a migration chain lasts without being renewed
+    'lease_ttl': 600,
+    # seconds a migration waits for migrations of other applications it depends on
+    'hold_countdown': 10,
+    # queue migration tasks are added to, define its rate in queue.yaml
+    'queue_name': 'default',
+    # version or module migration tasks run on, the version adding them by default
+    'task_target': None,
+    # taskqueue.TaskRetryOptions arguments of migration tasks, e.g. {'task_retry_limit': 5}
+    'task_retry': None,
+    #'migrations_dirs': _MIGRATION_DIRS,
+    }
+
+
+class MigrationLease(model.Model):
+    """
+    Run lease of the migration chain of an application, keyed by the
+
+    application name. Chains are identified by the ``chain`` task parameter.
+    """
+    chain = model.StringProperty(indexed=False)
+    action = model.StringProperty(indexed=False)
+    target_index = model.StringProperty(indexed=False)
+    expires = model.FloatProperty(indexed=False)
+
+    @classmethod
+    def _cache_key(cls, application):
+        return "%s:%s" % (cls._get_kind(), application)
+
+    @staticmethod
+    def new_chain():
+        """
+        Returns a new chain id.
+        """
+        return uuid.uuid4().hex
+
+    @classmethod
+    def holder(cls, application):
+        """
+        Returns the unexpired lease of ``application``, or None.
+        """
+        lease = model.Key(cls, application).get()
+        if lease is not None and lease.expires > time.time():
+            return lease
+
+    @classmethod
+    def acquire(cls, application, chain, ttl, action=None, target_index=None):
+        """
+        Takes the lease of ``application`` for ``chain`` for ``ttl`` seconds
+
+        unless another chain holds it. Returns the lease, held by ``chain``
+
+        if it was taken.
+        """
+        return cls._take(application, chain, ttl, action, target_index)
+
+    @classmethod
+    def renew(cls, application, chain, ttl):
+        """
+        Extends the lease of ``application`` held by ``chain`` by ``ttl``
+
+        seconds, taking it if it has expired. Returns False if another chain
+
+        holds the lease. The datastore is only written when half of the
+
+        lease time has passed.
+        """
+        cached = memcache.get(cls._cache_key(application))
+        if cached is not None and cached[0] == chain and cached[1] - time.time() > ttl / 2.0:
+            return True
+        return cls._take(application, chain, ttl).chain == chain
+
+    @classmethod
+    def release(cls, application, chain):
+        """
+        Releases the lease of ``application`` if ``chain`` holds it.
+        """
+        key = model.Key(cls, application)
+
+        def txn():
+            lease = key.get()
+            if lease is not None and lease.chain == chain:
+                key.delete()
+
+        ndb.transaction(txn, retries=10)
+        memcache.delete(cls._cache_key(application))
+
+    @classmethod
+    def _take(cls, application, chain, ttl, action=None, target_index=None):
+        key = model.Key(cls, application)
+
+        def txn():
+            lease = key.get()
+            now = time.time()
+            if lease is not None and lease.chain != chain and lease.expires > now:
+                return lease
+            if lease is None or lease.chain != chain:
+                lease = cls(key=key, chain=chain, action=action, target_index=target_index)
+            lease.expires = now + ttl
+            lease.put()
+            return lease
+
+        lease = ndb.transaction(txn, retries=10)
+        memcache.set(cls._cache_key(application), (lease.chain, lease.expires),
+                     time=max(int(lease.expires - time.time()), 1))
+        return lease
+
+
+class Migration(object):
+
+    sharding = True # whether sharded steps fan out to tasks
+    checkpoints = True # whether the position of steps is saved for resuming
+    dry_run = False # whether the steps run without committing anything
+    sample_batches = 1 # batches of every mapped step a dry run processes
+    count_limit = 100000 # entities counted at most to extrapolate a dry run
+    progress_flush_interval = 10 # seconds between stores of the progress counters
+    progress_batch = 100 # items added up locally before they are sent to a counter shard
+    workers = None # threads mapping shards in process instead of shard tasks
+
+    def __init__(self, id, steps, source, application=None, migration_model=MigrationEntry,
+                 path=None, hash=None, metadata=None):
+        self.id = id
+        self._steps = steps
+        self._source = source
+        self.path = path
+        self.hash = hash
+        self.metadata = metadata or {}
+        self.profile = bool(self.metadata.get('profile'))
+        depends = self.metadata.get('depends')
+        # specs of migrations the migration depends on, None if not declared
+        self.depends = [depends] if isinstance(depends, basestring) else \
+            (list(depends) if depends is not None else None)
+        self.chain_params = {} # CHAIN_PARAMS of the task
+        self.application = application
+        self.migration_model = migration_model
+        self.target_index = None # target migration index
+        self.direction = None # apply|rollback while steps are processed
+        self.step_index = None # index of the step being processed
+        self.cursor = None # cursor to resume the mapped query of the step from
+        self.deadline = None # time to continue in a new task at
+        self.shard = None # (shard, start, end) mapped by a shard task
+        self.fanned_out = False # whether shard tasks took over the step being processed
+        self.inline = False # whether the worker runs the next migration itself
+        self.finished = None # apply|rollback once the migration succeeded
+        self.resumed = False # whether an interrupted run is being resumed
+        self.progress_flushed = None # time the progress counters were last stored
+        self.progress_pending = 0 # processed items not sent to the counters yet
+        self.progress_started = False # whether the start time of the counters is set
+
+    def get_steps(self):
+        # lazy migrations are executed only when their steps are needed
+        if self._steps is None and self.path is not None:
+            described = self.hash
+            self._source, self.hash, self._steps = _load_migration(self.path)
+            self._check_hash(described)
+        return self._steps
+
+    def set_steps(self, steps):
+        self._steps = steps
+
+    steps = property(get_steps, set_steps)
+
+    def get_source(self):
+        if self._source is None and self.path is not None:
+            described = self.hash
+            self._source, self.hash = _read_source(self.path)
+            self._check_hash(described)
+        return self._source
+
+    def set_source(self, source):
+        self._source = source
+
+    source = property(get_source, set_source)
+
+    def _check_hash(self, described):
+        # a manifest can't tell files edited without changing their size, their
+        # hash is checked when they are read
+        if described is not None and described != self.hash:
+            logger.warning("Migration %s changed since the manifest was written", self.path)
+            _stale_manifest(os.path.dirname(self.path))
+
+    @property
+    def key(self):
+        return self.migration_model.key_for(self.application, self.id)
+
+    def get_status(self):
+        return get_statuses(self.migration_model, self.application, [self.id])[self.id]
+
+    def set_status(self, status):
+        #logger.info("setting the migration status to %s" % status)
+        self.transition(None, status)
+
+    status = property(get_status, set_status)
+
+    def transition(self, from_status, to_status):
+        """
+        Changes the migration status to ``to_status`` only if it is still
+
+        ``from_status``. Returns True if the status was changed.
+        """
+        return self.migration_model.transition(self.application, self.id,
+                                               from_status, to_status)
+
+    def fail(self):
+        #logger.info("failing the migration")
+        if self.dry_run:
+            return
+        if not self.transition("apply in process", "apply failed"):
+            self.transition("rollback in process", "rollback failed")
+
+
+
+    def succeed(self):
+        #logger.info("succeding the migration with current status %s " % self.status)
+        if self.dry_run:
+            return
+        if self.transition("apply in process", "apply success"):
+            action = "apply"
+        elif self.transition("rollback in process", "rollback success"):
+            action = "rollback"
+        else:
+            # already finished, the chain has been advanced then
+            return
+        self.finished = action
+        if self.inline:
+            return
+        call_next(read_migrations(get_migration_dirs(), lazy=True), self.application,
+                  self.target_index, action, WORKER_URL, self.chain_params,
+                  after=self)
+
 
-    migrations path occurs.
+    def isapplied(self, ready_only=False):
+        status = self.status
+        if ready_only:
+            return status == "apply success"
+        return status != "new"
 
-    """
 
-    cur_path = os.path.dirname(sys._getframe(1).f_globals["__file__"])
+    def apply(self, force=False, dry_run=False):
+        """
+        Applies the migration. With ``dry_run`` nothing is committed, a cost
 
-    global _MIGRATION_DIRS
+        report (see ``dryrun.dry_run``) is returned instead.
+        """
+        if dry_run:
+            return run_dry(self, 'apply', self.sample_batches, self.count_limit)
+        if self.transition("new", "apply in process"):
+            start = 0
+        else:
+            start = self.get_checkpoint("apply in process")
+            if start is None:
+                return
+        #logger.info("Applying %s", self.id)
+        self.process('apply', force=force, start=start)
 
-    abs_path = os.path.normpath(os.path.abspath(
-                                    os.path.join(cur_path, migrations_path)
-                                ))
-    valid_appname = app_name.strip()
 
-    for known_app, known_path in _MIGRATION_DIRS:
-        if valid_appname == known_app:
-            raise AlreadyRegisteredError("Application '%s' has already been registered" % valid_appname)
-        if abs_path == known_path:
-            raise AlreadyRegisteredError("Migration directory '%s' has already been registered for '%s' application" % (abs_path, known_app))
 
-    _MIGRATION_DIRS.add((valid_appname, abs_path))
+    def rollback(self, force=False, dry_run=False):
+        """
+        Rolls the migration back. With ``dry_run`` nothing is committed, a
 
+        cost report (see ``dryrun.dry_run``) is returned instead.
+        """
+        if dry_run:
+            return run_dry(self, 'rollback', self.sample_batches, self.count_limit)
+        if self.transition("apply success", "rollback in process"):
+            start = 0
+        else:
+            start = self.get_checkpoint("rollback in process")
+            if start is None:
+                return
+        #logger.info("Rolling back %s", self.id)
+        self.process('rollback', force=force, start=start)
 
+    def get_checkpoint(self, status):
+        """
+        Returns index of the step to resume the migration from when a previous
 
-class MigrationEntry(model.Model):
-    """
-    Represents Migration in storage.
-    """
-    id = model.StringProperty()
-    application = model.StringProperty()
-    ctime = model.DateTimeProperty(auto_now_add=True)
+        run with ``status`` was interrupted, None if there's nothing to resume.
 
-    status = model.StringProperty(required=True,
-                                  choices=["apply in process",
-                                           "rollback in process",
-                                           "apply failed",
-                                           "rollback failed",
-                                           "apply success",
-                                           "rollback success",
-                                           ])
+        Sets ``cursor`` of the mapped query to resume from.
+        """
+        entry = self.key.get()
+        if entry is None or entry.status != status or entry.pending_shards:
+            return None
+        logger.info("Resuming %s of %s from step %d", status, self.id, entry.step)
+        self.cursor = entry.cursor
+        self.resumed = True
+        return entry.step
+
+    def out_of_time(self):
+        """
+        Returns True when the task should stop and continue in a new one.
+        """
+        return self.deadline is not None and time.time() >= self.deadline
 
-    @classmethod
-    def _pre_delete_hook(cls, key):
-        memcache.delete(key.kind())
+    def continue_later(self):
+        """
+        Starts a task continuing the migration from its checkpoint and stops
 
-    def _post_put_hook(self, future):
-        super(MigrationEntry, self)._post_put_hook(future)
-        memcache.delete(self.key.kind())
+        processing of the steps.
+        """
+        logger.info("Continuing %s of %s in a new task", self.direction, self.id)
+        if self.shard is not None:
+            shard, start, end = self.shard
+            self._enqueue(SHARD_URL, {'application': self.application,
+                                      'id': self.id,
+                                      'action': self.direction,
+                                      'target_index': self.target_index,
+                                      'shard': shard,
+                                      'start': start.urlsafe() if start is not None else '',
+                                      'end': end.urlsafe() if end is not None else '',
+                                      'cursor': self.cursor or '',
+                                      })
+        else:
+            migrations = read_migrations(get_migration_dirs(), lazy=True)[self.application]
+            self._enqueue(WORKER_URL, {'index': [m.id for m in migrations].index(self.id),
+                                       'action': self.direction,
+                                       'application': self.application,
+                                       'target_index': self.target_index,
+                                       })
+        raise StepDeferred()
+
+    def _enqueue(self, url, params):
+        params.update(self.chain_params)
+        _enqueue(url, params)
+
+    def set_progress_total(self, total):
+        """
+        Sets the number of items the running migration is expected to process.
+        """
+        if self.dry_run or self.direction is None:
+            return
+        memcache.set(self._progress_key() + ":total", total)
+        self._start_progress()
+        self.flush_progress()
 
-default_config = {
-    'migration_model':  MigrationEntry,
-    #'migrations_dirs': _MIGRATION_DIRS,
-    }
+    def progress(self, done=1):
+        """
+        Adds ``done`` processed items to the progress of the running migration.
 
+        Increments are added up locally and sent to a random memcache counter
 
-class Migration(object):
+        shard every ``progress_batch`` items, the counters are stored in the
 
-    key = None
+        entry every ``progress_flush_interval`` seconds.
+        """
+        if self.dry_run or self.direction is None or not done:
+            return
+        self._start_progress()
+        self.progress_pending += done
+        if self.progress_flushed is None or \
+                time.time() - self.progress_flushed >= self.progress_flush_interval:
+            self.flush_progress()
+        elif self.progress_pending >= self.progress_batch:
+            self.send_progress()
+
+    def send_progress(self):
+        """
+        Sends the items added up by ``progress`` to a memcache counter shard.
+        """
+        if not self.progress_pending:
+            return
+        memcache.incr("%s:%d" % (self._progress_key(), random.randrange(PROGRESS_SHARDS)),
+                      self.progress_pending, initial_value=0)
+        self.progress_pending = 0
 
-    def __init__(self, id, steps, source, application=None, migration_model=MigrationEntry):
-        self.id = id
-        self.steps = steps
-        self.source = source
-        self.application = application
-        self.migration_model = migration_model
-        self.target_index = None # target migration index
+    def _start_progress(self):
+        if not self.progress_started:
+            memcache.add(self._progress_key() + ":started", time.time())
+            self.progress_started = True
 
+    def get_progress(self):
+        """
+        Returns the ``progress_report`` of the running migration, or None.
+        """
+        progress = get_progress(self.migration_model, self.application,
+                                [(self.id, self.direction)]).get((self.id, self.direction))
+        if progress is not None:
+            return progress_report(**progress)
 
+    def flush_progress(self):
+        """
+        Stores the progress counters of the running migration in its entry.
 
-    def get_status(self):
-        status = "new"
-        if self.key is not None:
-            migration_object = self.key.get()
-            if migration_object:
-                return migration_object.status
+        Shard tasks only send their items to the counters, the task that
 
-        migration_query = self.migration_model.query(self.migration_model.id == self.id,
-                                                    self.migration_model.application == self.application,
-                                                    )
-        if migration_query.count() > 0:
-            status = migration_query.get().status
+        finishes the last shard stores them. Failing to store the counters
 
-        return status
+        doesn't fail the migration, they are stored by the next flush.
+        """
+        self.send_progress()
+        if ndb.in_transaction() or self.shard is not None:
+            # stored by a later call outside of the step transaction or shards
+            return
+        self.progress_flushed = time.time()
+        progress = get_progress(self.migration_model, self.application,
+                                [(self.id, self.direction)]).get((self.id, self.direction))
+        if progress is None:
+            return
+        try:
+            self.migration_model.set_progress(self.application, self.id, **progress)
+        except datastore_errors.Error:
+            logger.warning("Failed to store the progress of migration %s of %s",
+                           self.id, self.application, exc_info=True)
 
-    def set_status(self, status):
-        #logger.info("setting the migration status to %s" % status)
-        if self.key is not None:
-            taskqueue.add(url="/_ah/migration/tasks/status/",
-                          params={'id': self.key.id(),
-                                  'status': status})
+    def _progress_key(self):
+        return _progress_key(self.migration_model, self.application, self.id, self.direction)
 
-    status = property(get_status, set_status)
+    def checkpoint(self, step, cursor=None, metrics=None):
+        """
+        Saves index of the next ``step`` to process and ``cursor`` of its
 
-    def fail(self):
-        #logger.info("failing the migration")
-        #import time; time.sleep(0.2)
-        if self.status == "apply in process":
-            self.status = "apply failed"
-        if self.status == "rollback in process":
-            self.status = "rollback failed"
+        mapped query, along with ``metrics`` of the processed step.
+        """
+        if self.checkpoints:
+            self.migration_model.checkpoint(self.application, self.id, step, cursor, metrics)
 
+    def get_metrics(self, recorder, retries=0):
+        """
+        Returns ``StepMetrics`` of the current step recorded by ``recorder``.
+        """
+        if recorder.started is None:
+            return None
+        return StepMetrics(step=self.step_index,
+                           direction=self.direction,
+                           started=datetime.utcfromtimestamp(recorder.started),
+                           finished=datetime.utcfromtimestamp(recorder.started + recorder.duration),
+                           duration=recorder.duration,
+                           rpcs=recorder.rpcs,
+                           reads=recorder.reads,
+                           writes=recorder.writes,
+                           retries=retries)
+
+    def get_sequence(self, direction):
+        """
+        Returns the steps in the order they are processed for ``direction``.
+        """
+        if direction == 'rollback':
+            return list(reversed(self.steps))
+        return list(self.steps)
 
+    def fan_out(self, ranges):
+        """
+        Starts a task per key range for the step being processed and stops
 
-    def succeed(self):
-        #import time; time.sleep(0.2)
-        #logger.info("succeding the migration with current status %s " % self.status)
-        action = None
-        if self.status == "apply in process":
-            self.status = "apply success"
-            action = "apply"
-        if self.status == "rollback in process":
-            self.status = "rollback success"
-            action = "rollback"
-        call_next(read_migrations(get_migration_dirs()), self.application,
-                                  self.target_index, action, '/_ah/migration/tasks/worker/')
+        processing of the steps. The last finished shard continues them.
 
+        With ``workers`` the ranges are mapped by threads of this process.
+        """
+        if self.workers:
+            return self.map_shards(ranges)
+        shards = ["%d/%d" % (self.step_index, n) for n in range(len(ranges))]
+        # the step checkpoint is saved before any shard can finish and advance it
+        self.migration_model.start_shards(self.application, self.id, self.step_index, shards)
+        self.fanned_out = True
+        for shard, (start, end) in zip(shards, ranges):
+            self._enqueue(SHARD_URL, {'application': self.application,
+                                      'id': self.id,
+                                      'action': self.direction,
+                                      'target_index': self.target_index,
+                                      'shard': shard,
+                                      'start': start.urlsafe() if start is not None else '',
+                                      'end': end.urlsafe() if end is not None else '',
+                                      })
+        raise StepDeferred()
+
+    def map_shards(self, ranges):
+        """
+        Maps key ``ranges`` of the step being processed with ``workers``
 
-    def isapplied(self, ready_only=False):
-        if self.key is not None:
-            if ready_only:
-                if self.key.get().status != "apply success":
-                    return False
-            return True
+        threads, recording their datastore RPCs for the step.
+        """
+        (step,) = self.get_sequence(self.direction)[self.step_index].steps
+        mapper = step._apply if self.direction == 'apply' else step._rollback
 
-        query = self.migration_model.query(self.migration_model.id == self.id,
-                                           self.migration_model.application == self.application,
-                                          )
-        if ready_only:
-            query = query.filter(self.migration_model.status == "apply success")
-        return query.count() > 0
+        def map_range(key_range):
+            start, end = key_range
+            with Recorder() as recorder:
+                mapper.run(None, start=start, end=end)
+            return recorder
 
+        pool = ThreadPool(self.workers)
+        try:
+            for recorder in pool.map(map_range, ranges):
+                add_recorded(recorder)
+        finally:
+            pool.close()
 
-    def apply(self, force=False):
-        if self.isapplied():
-            return
-        #logger.info("Applying %s", self.id)
-        migration = self.migration_model(id=self.id, application=self.application, status="apply in process")
-        self.key = migration.put()
-        Migration._process_steps(self.steps, 'apply', self, force=force)
+    def step_processed(self, index, recorder):
+        """
+        Called with the Recorder of every processed step, for reporting.
+        """
+        pass
 
+    def run_shard(self, direction, shard, start=None, end=None, cursor=None):
+        """
+        Maps the key range [start, end) of the sharded step, from ``cursor``
 
+        if the shard is continued. The task that finishes the last shard
 
-    def rollback(self, force=False):
-        if not self.isapplied(ready_only=True):
+        processes the rest of the steps.
+        """
+        entry = self.key.get()
+        if entry is None or entry.status != "%s in process" % direction or \
+                shard not in entry.pending_shards:
+            # tasks may be delivered twice, a finished shard is not mapped again
             return
-        #logger.info("Rolling back %s", self.id)
-        migration = self.migration_model.query(self.migration_model.id == self.id,
-                                               self.migration_model.application == self.application).get()
-        if migration is not None:
-            migration.status="rollback in process"
-            self.key = migration.put()
+        step_index = int(shard.split("/")[0])
+        (step,) = self.get_sequence(direction)[step_index].steps
+        mapper = step._apply if direction == 'apply' else step._rollback
+        self.direction = direction
+        self.step_index = step_index
+        self.shard = (shard, start, end)
+        # shards share the entry, so only the finished steps are saved
+        self.checkpoints = False
+        recorder = Recorder()
+        try:
+            with recorder:
+                mapper.run(self, cursor=cursor, start=start, end=end)
+        except StepDeferred:
+            self.send_progress()
+            self.migration_model.checkpoint(self.application, self.id,
+                                            metrics=self.get_metrics(recorder, int(bool(cursor))))
+            return
+        except Exception:
+            self.fail()
+            raise
+        self.send_progress()
+        if self.migration_model.finish_shard(self.application, self.id, shard,
+                                             self.get_metrics(recorder, int(bool(cursor)))):
+            self.shard = None
+            self.cursor = None
+            self.checkpoints = True
+            self.flush_progress()
+            self.process(direction, start=step_index + 1)
+
+    def process(self, direction, force=False, start=0):
+        """
+        Processes the steps for ``direction`` from step ``start``, under
 
-        Migration._process_steps(reversed(self.steps), 'rollback', self, force=force)
+        cProfile if ``profile`` is set.
+        """
+        steps = self.get_sequence(direction)
+        if not self.profile:
+            return Migration._process_steps(steps, direction, self, force=force, start=start)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(Migration._process_steps, steps, direction, self,
+                             force=force, start=start)
+        finally:
+            try:
+                self.migration_model.add_profile(self.application, self.id, direction, profiler)
+            except Exception:
+                logger.exception("Failed to store profile of %s", self.id)
 
     @staticmethod
-    def _process_steps(steps, direction, migration, force=False):
+    def _process_steps(steps, direction, migration, force=False, start=0):
 
         reverse = {
             'rollback': 'apply',
             'apply': 'rollback',
             }[direction]
 
+        migration.direction = direction
         executed_steps = []
-        for step in steps:
+        for index, step in enumerate(steps):
+            if index < start:
+                continue
+            migration.step_index = index
+            recorder = Recorder()
+            retries = int(index == start and migration.resumed)
             try:
-                getattr(step, direction)(migration=migration, force=force)
+                if index > start and migration.out_of_time():
+                    migration.continue_later()
+                with recorder:
+                    getattr(step, direction)(migration=migration, force=force)
                 executed_steps.append(step)
+                migration.send_progress()
+                migration.step_processed(index, recorder)
+                migration.cursor = None
+                migration.checkpoint(index + 1, metrics=migration.get_metrics(recorder, retries))
+
+            except StepDeferred:
+                migration.send_progress()
+                metrics = migration.get_metrics(recorder, retries)
+                if migration.fanned_out:
+                    # shards own the checkpoint now, the last one advances it
+                    migration.fanned_out = False
+                    if metrics is not None:
+                        migration.checkpoint(None, metrics=metrics)
+                elif metrics is not None:
+                    migration.checkpoint(index, migration.cursor, metrics)
+                return
 
             except datastore_errors.TransactionFailedError:
                 exc_info = sys.exc_info()
@@ -285,6 +1601,9 @@ class Migration(object):
                 migration.fail()
                 raise
 
+        # succeeds migrations whose steps don't do it themselves, e.g. map_step
+        migration.succeed()
+
 class PostApplyHookMigration(Migration):
     """
     A special migration that is run after successfully applying a set of migrations.
@@ -292,7 +1611,12 @@ class PostApplyHookMigration(Migration):
     script is called.
     """
 
-    def apply(self, force=False):
+    sharding = False # has no entry to track shards
+    checkpoints = False
+
+    def apply(self, force=False, dry_run=False):
+        if dry_run:
+            return run_dry(self, 'apply', self.sample_batches, self.count_limit)
         logger.info("Applying %s", self.id)
         self.__class__._process_steps(
             self.steps,
@@ -301,7 +1625,9 @@ class PostApplyHookMigration(Migration):
             force=True
         )
 
-    def rollback(self, force=False):
+    def rollback(self, force=False, dry_run=False):
+        if dry_run:
+            return run_dry(self, 'rollback', self.sample_batches, self.count_limit)
         logger.info("Rolling back %s", self.id)
         self.__class__._process_steps(
             reversed(self.steps),
@@ -333,15 +1659,18 @@ class Transaction(StepBase):
 
     def apply(self, migration, force=False):
 
+        @ndb.tasklet
         def callback(steps, migration, force):
             for step in steps:
-                step.apply(migration, force=force)
+                yield step.apply_async(migration, force=force)
 
         try:
-            if self.fake_transaction:
-                callback(self.steps, migration, force)
+            if self.fake_transaction or migration.dry_run:
+                callback(self.steps, migration, force).get_result()
             else:
-                ndb.transaction(lambda:callback(self.steps, migration, force), xg=True)
+                ndb.transaction_async(lambda:callback(self.steps, migration, force), xg=True).get_result()
+        except StepDeferred:
+            raise
         #except datastore_errors.TransactionFailedError:
         except Exception, err:
             if force or self.ignore_errors in ('apply', 'all'):
@@ -352,15 +1681,18 @@ class Transaction(StepBase):
 
 
     def rollback(self, migration, force=False):
+        @ndb.tasklet
         def callback(steps, migration, force):
             for step in reversed(steps):
-                step.rollback(migration, force=force)
+                yield step.rollback_async(migration, force=force)
 
         try:
-            if self.fake_transaction:
-                callback(self.steps, migration, force)
+            if self.fake_transaction or migration.dry_run:
+                callback(self.steps, migration, force).get_result()
             else:
-                ndb.transaction(lambda:callback(self.steps, migration, force), xg=True)
+                ndb.transaction_async(lambda:callback(self.steps, migration, force), xg=True).get_result()
+        except StepDeferred:
+            raise
         #except datastore_errors.TransactionFailedError:
         except Exception:
             if force or self.ignore_errors in ('rollback', 'all'):
@@ -394,107 +1726,409 @@ class MigrationStep(StepBase):
         force
             If true, errors will be logged but not be re-raised
         """
-        #logger.info(" - applying step %d", self.id)
-        if not self._apply:
-            return
-
-        if callable(self._apply):
-            self._apply(migration)
+        self.apply_async(migration, force=force).get_result()
 
+    def apply_async(self, migration, force=False):
+        """
+        Apply the step, returns a future. The step callable may be a tasklet.
+        """
+        #logger.info(" - applying step %d", self.id)
+        if not self._apply or not callable(self._apply):
+            return as_future(None)
 
+        return as_future(self._apply(migration))
 
     def rollback(self, migration, force=False):
         """
         Rollback the step.
         """
+        self.rollback_async(migration, force=force).get_result()
+
+    def rollback_async(self, migration, force=False):
+        """
+        Rollback the step, returns a future. The step callable may be a tasklet.
+        """
         #logger.info(" - rolling back step %d", self.id)
-        if self._rollback is None:
-            return
+        if self._rollback is None or not callable(self._rollback):
+            return as_future(None)
+
+        return as_future(self._rollback(migration))
 
-        if callable(self._rollback):
-            self._rollback(migration)
 
+_MIGRATIONS_CACHE = {}
+_MIGRATIONS_CACHE_LOCK = threading.RLock()
 
-def read_migrations(directories=_MIGRATION_DIRS, names=None, migration_model=MigrationEntry):
+
+def clear_migrations_cache():
     """
-    Return a ``MigrationList`` containing all migrations from ``directory``.
-    If ``names`` is given, this only return migrations with names from the given list (without file extensions).
+    Drops all cached migration directories and files, so the next
+
+    ``read_migrations`` call re-reads and re-executes every migration file.
     """
-    migrations_dict = {}
-    migrations = MigrationList(migration_model)
-    paths = []#set([])
-    for app_name, dir in directories:
-        migrations_dict[app_name] = MigrationList(migration_model)
-        for path in os.listdir(dir):
-            if path.endswith('.py'):
-                paths.append( (app_name, os.path.join(dir, path)) )
-    paths.sort()
+    with _MIGRATIONS_CACHE_LOCK:
+        _MIGRATIONS_CACHE.clear()
 
-    for app_name, path in paths:
 
-        filename = os.path.splitext(os.path.basename(path))[0]
+def _list_migration_dir(dir):
+    """
+    Returns sorted migration file paths of ``dir``. The listing is cached
 
-        if filename.startswith('post-apply'):
-            migration_class = PostApplyHookMigration
-        else:
-            migration_class = Migration
+    until the directory modification time changes.
+    """
+    mtime = os.stat(dir).st_mtime
+    cache_key = ('dir', dir)
+    cached = _MIGRATIONS_CACHE.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    paths = sorted(os.path.join(dir, path) for path in os.listdir(dir)
+                   if path.endswith('.py'))
+    with _MIGRATIONS_CACHE_LOCK:
+        _MIGRATIONS_CACHE[cache_key] = (mtime, paths)
+    return paths
 
-        if migration_class is Migration and names is not None and filename not in names:
-            continue
 
-        step_id = count(0)
-        transactions = []
+def read_manifest(dir):
+    """
+    Returns the manifest of migration directory ``dir`` written at build
+
+    time, or None if it is missing or the files changed since: files were
 
-        def step(apply, rollback=None, ignore_errors=None, fake_transaction=True):
-            """
-            Wrap the given apply and rollback code in a transaction, and add it
+    added or removed, a file size differs, or a file read later turned out
 
-            to the list of steps. Return the transaction-wrapped step.
+    to have another hash. Modification times are not compared, deployments
+
+    don't keep them.
+    """
+    path = os.path.join(dir, MANIFEST_NAME)
+    try:
+        signature = _file_signature(path)
+    except OSError:
+        return None
 
-            If fake_transaction is True, transaction won't actually run step in ndb transaction.
+    manifest = _get_cached('manifest', dir, signature)
+    if manifest is None:
+        file = open(path, 'r')
+        try:
+            manifest = json.load(file)
+        except ValueError:
+            logger.warning("Ignoring invalid migration manifest %s", path)
+            return None
+        finally:
+            file.close()
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        with _MIGRATIONS_CACHE_LOCK:
+            _MIGRATIONS_CACHE[('manifest', dir)] = (signature, manifest)
+
+    if manifest.get('stale'):
+        return None
+    if [os.path.basename(listed) for listed in _list_migration_dir(dir)] != \
+            [described['file'] for described in manifest['files']]:
+        return None
+    for described in manifest['files']:
+        try:
+            if os.stat(os.path.join(dir, described['file'])).st_size != described['size']:
+                return None
+        except OSError:
+            return None
+    return manifest
 
-            ignore_errors may be "apply", "rollback" or "all". If not provided all errors will be raised
 
-            """
-            t = Transaction([MigrationStep(step_id.next(), apply, rollback)], ignore_errors, fake_transaction=fake_transaction)
-            transactions.append(t)
-            return t
+def _stale_manifest(dir):
+    # a file of ``dir`` doesn't match the hash in its manifest, it's scanned again
+    cached = _MIGRATIONS_CACHE.get(('manifest', dir))
+    if cached is not None:
+        cached[1]['stale'] = True
 
-        def transaction(*steps, **kwargs):
-            """
-            Wrap the given list of steps in a single transaction, removing the
-            default transactions around individual steps.
-            """
-            ignore_errors = kwargs.pop('ignore_errors', None)
-            assert kwargs == {}
 
-            transaction = Transaction([], ignore_errors)
-            for oldtransaction in steps:
-                if oldtransaction.ignore_errors is not None:
-                    raise AssertionError("ignore_errors cannot be specified within a transaction")
-                try:
-                    (step,) = oldtransaction.steps
-                except ValueError:
-                    raise AssertionError("Transactions cannot be nested")
-                transaction.steps.append(step)
-                transactions.remove(oldtransaction)
-            transactions.append(transaction)
-            return transaction
+def _parse_migration(path, source, hash=None):
+    """
+    Executes migration ``source`` read from ``path`` and returns its steps.
+
+    The compiled code is cached by the source ``hash`` when it is given.
+    """
+    step_id = count(0)
+    transactions = []
+
+    def step(apply, rollback=None, ignore_errors=None, fake_transaction=True):
+        """
+        Wrap the given apply and rollback code in a transaction, and add it
+
+        to the list of steps. Return the transaction-wrapped step.
+
+        If fake_transaction is True, transaction won't actually run step in ndb transaction.
+
+        ignore_errors may be "apply", "rollback" or "all". If not provided all errors will be raised
+
+        """
+        t = Transaction([MigrationStep(step_id.next(), apply, rollback)], ignore_errors, fake_transaction=fake_transaction)
+        transactions.append(t)
+        return t
+
+    def transaction(*steps, **kwargs):
+        """
+        Wrap the given list of steps in a single transaction, removing the
+        default transactions around individual steps.
+        """
+        ignore_errors = kwargs.pop('ignore_errors', None)
+        assert kwargs == {}
+
+        transaction = Transaction([], ignore_errors)
+        for oldtransaction in steps:
+            if oldtransaction.ignore_errors is not None:
+                raise AssertionError("ignore_errors cannot be specified within a transaction")
+            try:
+                (step,) = oldtransaction.steps
+            except ValueError:
+                raise AssertionError("Transactions cannot be nested")
+            if isinstance(step._apply, Mapper) or isinstance(step._rollback, Mapper):
+                raise AssertionError("map_step cannot be run in a transaction")
+            transaction.steps.append(step)
+            transactions.remove(oldtransaction)
+        transactions.append(transaction)
+        return transaction
+
+    def map_step(query, fn, batch_size=100, rollback=None, rollback_query=None, ignore_errors=None,
+                 shards=1, throttle=None):
+        """
+        Add a step applying ``fn`` to every entity of ``query`` in batches of
+
+        ``batch_size``. ``rollback`` is mapped over ``rollback_query`` (or
+
+        ``query``) when the step is rolled back. See ``Mapper`` for what
+
+        ``fn`` and ``rollback`` should return, for ``shards`` and ``throttle``.
+        """
+        if rollback is not None:
+            rollback = Mapper(rollback_query or query, rollback, batch_size, shards, throttle)
+        return step(Mapper(query, fn, batch_size, shards, throttle), rollback, ignore_errors=ignore_errors)
+
+    if hash is None:
+        migration_code = compile(source, path, 'exec')
+    else:
+        migration_code = _compile_migration(path, source, hash)
+
+    ns = {'step' : step, 'transaction': transaction, 'map_step': map_step,
+         # 'succeed': succeed, 'fail': fail
+         }
+    exec migration_code in ns
+    return transactions
+
+
+_CODE_CACHE = {}
+_CODE_MAGIC = imp.get_magic().encode('hex')
+
+
+def _compile_migration(path, source, hash):
+    """
+    Returns the code object of migration ``source`` read from ``path``.
+
+    Code objects are cached by source ``hash`` in process memory, in
+
+    memcache and in files written by ``write_code_cache``.
+    """
+    code = _CODE_CACHE.get((path, hash))
+    if code is None:
+        code = _load_code(path, hash)
+    if code is None:
+        code = compile(source, path, 'exec')
+        if CODE_CACHE_MEMCACHE:
+            memcache.set(_code_cache_key(path, hash), marshal.dumps(code))
+    _CODE_CACHE[(path, hash)] = code
+    return code
+
+
+def _code_cache_key(path, hash):
+    return "migration:code:%s:%s" % (_CODE_MAGIC, hashlib.sha1("%s:%s" % (path, hash)).hexdigest())
+
 
+def _code_header(hash):
+    # compiled code is only valid for the source and the python version it was compiled from
+    return "%s %s\n" % (_CODE_MAGIC, hash)
+
+
+def _load_code(path, hash):
+    """
+    Returns the cached code object of migration ``path`` with source ``hash``
+
+    from its compiled file or memcache, or None.
+    """
+    data = None
+    try:
+        file = open(path + CODE_CACHE_EXTENSION, 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            if file.readline() == _code_header(hash):
+                data = file.read()
+        finally:
+            file.close()
+    if data is None and CODE_CACHE_MEMCACHE:
+        data = memcache.get(_code_cache_key(path, hash))
+    if data is not None:
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            logger.warning("Ignoring corrupted compiled code of %s", path)
+
+
+def write_code_cache(directories=_MIGRATION_DIRS):
+    """
+    Compiles migration files of ``directories`` (a set of ``(app_name, path)``)
+
+    into files next to them, so instances load them without compiling.
+
+    Run it at build time. Returns the paths of the written files.
+    """
+    written = []
+    for app_name, dir in directories:
+        for path in _list_migration_dir(dir):
+            source, hash = _read_source(path)
+            code = compile(source, path, 'exec')
+            file = open(path + CODE_CACHE_EXTENSION, 'wb')
+            try:
+                file.write(_code_header(hash))
+                file.write(marshal.dumps(code))
+            finally:
+                file.close()
+            written.append(path + CODE_CACHE_EXTENSION)
+    return written
+
+
+def _get_cached(kind, path, signature):
+    cached = _MIGRATIONS_CACHE.get((kind, path))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def _read_source(path):
+    """
+    Returns ``(source, hash)`` of migration file ``path`` without executing it.
+    """
+    signature = _file_signature(path)
+    described = _get_cached('source', path, signature)
+    if described is None:
         file = open(path, 'r')
         try:
             source = file.read()
-            migration_code = compile(source, file.name, 'exec')
         finally:
             file.close()
+        described = (source, hashlib.sha1(source).hexdigest())
+        with _MIGRATIONS_CACHE_LOCK:
+            _MIGRATIONS_CACHE[('source', path)] = (signature, described)
+    return described
+
+
+def _read_metadata(path):
+    """
+    Returns a dict of METADATA variables assigned literals at the module
+
+    level of migration file ``path``, without executing it.
+    """
+    signature = _file_signature(path)
+    metadata = _get_cached('metadata', path, signature)
+    if metadata is None:
+        source, hash = _read_source(path)
+        metadata = {}
+        for node in ast.parse(source, path).body:
+            if not isinstance(node, ast.Assign):
+                continue
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in METADATA:
+                    try:
+                        metadata[target.id] = ast.literal_eval(node.value)
+                    except ValueError:
+                        logger.warning("%s of %s should be a literal", target.id, path)
+        with _MIGRATIONS_CACHE_LOCK:
+            _MIGRATIONS_CACHE[('metadata', path)] = (signature, metadata)
+    return metadata
+
+
+def _load_migration(path, reload=False):
+    """
+    Returns ``(source, hash, steps)`` of migration file ``path``. Parsed
+
+    files are cached process-wide and re-read only when the file
+
+    modification time or size changes, or when ``reload`` is True.
+    """
+    signature = _file_signature(path)
+    parsed = None if reload else _get_cached('file', path, signature)
+    if parsed is not None:
+        return parsed
+
+    with _MIGRATIONS_CACHE_LOCK:
+        # another thread could parse the file while we were waiting
+        parsed = None if reload else _get_cached('file', path, signature)
+        if parsed is None:
+            if reload:
+                _MIGRATIONS_CACHE.pop(('source', path), None)
+            source, hash = _read_source(path)
+            parsed = (source, hash, _parse_migration(path, source, hash))
+            _MIGRATIONS_CACHE[('file', path)] = (signature, parsed)
+    return parsed
+
+
+def read_migrations(directories=_MIGRATION_DIRS, names=None, migration_model=MigrationEntry, reload=False,
+                    lazy=False, manifests=True):
+    """
+    Return a ``MigrationList`` containing all migrations from ``directory``.
+    If ``names`` is given, this only return migrations with names from the given list (without file extensions).
+    Parsed migration files are cached between calls, pass ``reload=True`` to re-read them.
+    If ``lazy`` is True, migration files are not executed until the steps of a migration are needed.
+    Directories are described by their manifests when they are up to date, pass ``manifests=False``
+    to scan them anyway.
+    """
+    if reload:
+        clear_migrations_cache()
+
+    migrations_dict = {}
+    paths = []#set([])
+    for app_name, dir in directories:
+        migrations_dict[app_name] = MigrationList(migration_model)
+        manifest = read_manifest(dir) if manifests else None
+        if manifest is not None:
+            # described at build time, the directory is not scanned
+            for described in manifest['files']:
+                paths.append( (app_name, os.path.join(dir, described['file']), described) )
+        else:
+            for path in _list_migration_dir(dir):
+                paths.append( (app_name, path, None) )
+    paths.sort(key=lambda item: item[:2])
+
+    for app_name, path, described in paths:
+
+        filename = os.path.splitext(os.path.basename(path))[0]
+
+        if filename.startswith('post-apply'):
+            migration_class = PostApplyHookMigration
+        else:
+            migration_class = Migration
+
+        if migration_class is Migration and names is not None and filename not in names:
+            continue
+
+        if lazy and described is not None:
+            transactions = source = None
+            hash = described['hash']
+        elif lazy:
+            transactions = None
+            source, hash = _read_source(path)
+        else:
+            source, hash, transactions = _load_migration(path)
+        metadata = described['metadata'] if described is not None else _read_metadata(path)
 
-        ns = {'step' : step, 'transaction': transaction,
-             # 'succeed': succeed, 'fail': fail
-             }
-        exec migration_code in ns
         migration = migration_class(os.path.basename(filename), transactions,
                                     source, application=app_name,
-                                    migration_model=migration_model)
+                                    migration_model=migration_model,
+                                    path=path, hash=hash, metadata=metadata)
 
         if migration_class is PostApplyHookMigration:
             migrations_dict[app_name].post_apply.append(migration)
@@ -520,27 +2154,43 @@ class MigrationList(list):
         self.post_apply = post_apply if post_apply else []
 
 
-    def url_query_for(self, action, migration):
+    def url_query_for(self, action, migration, index=None):
         """
         Returns url query string for provided action and migration.
         Possible actions are:
             - apply;
             - rollback;
         migration - migration from migration list
+        index - index of the migration in the list, looked up if not given
 
         """
         return urllib.urlencode((('action', action),
-                                 ('index', self.index(migration)),
+                                 ('index', self.index(migration) if index is None else index),
                                  ('app', getattr(migration, 'application', None))
                                 ))
 
+    def statuses(self):
+        """
+        Return a dict of migration ids to their statuses. Statuses come from
+
+        the memcache snapshot, missing ones are fetched with a single get_multi.
+        """
+        ids = {}
+        for m in self:
+            ids.setdefault(m.application, []).append(m.id)
+        statuses = {}
+        for application, app_ids in ids.items():
+            statuses.update(get_statuses(self.migration_model, application, app_ids))
+        return statuses
+
     def to_apply(self):
         """
         Return a list of the subset of migrations not already applied.
         """
+        statuses = self.statuses()
         return self.__class__(
             self.migration_model,
-            [ m for m in self if not m.isapplied() ],
+            [ m for m in self if statuses[m.id] == "new" ],
             self.post_apply
         )
 
@@ -551,9 +2201,10 @@ class MigrationList(list):
 
         The order of migrations will be reversed.
         """
+        statuses = self.statuses()
         return self.__class__(
             self.migration_model,
-            list(reversed([m for m in self if m.isapplied(ready_only=True)])),
+            list(reversed([m for m in self if statuses[m.id] == "apply success"])),
             self.post_apply
         )
 
@@ -5,14 +5,18 @@ from webapp2 import Route
 from webapp2_extras.routes import PathPrefixRoute
 
 
-from ..handlers import MigrationHandler, QueueHandler, MigrationWorker, MigrationStatus
+from ..handlers import MigrationHandler, QueueHandler, MigrationWorker, MigrationShardWorker, \
+    MigrationProfileHandler, MigrationStatus, MigrationStatusAPI
 
 
 routes = [
 
     Route('/', MigrationHandler, name='migration'),
+    Route('/profile/', MigrationProfileHandler, name='migration_profile'),
+    Route('/status.json', MigrationStatusAPI, name='migration_status_api'),
     Route('/tasks/migrate/', QueueHandler, name='migration_queue'),
     Route('/tasks/worker/', MigrationWorker, name='migration_worker'),
+    Route('/tasks/shard/', MigrationShardWorker, name='migration_shard'),
     Route('/tasks/status/', MigrationStatus, name='migration_status'),
 
     ]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Applies or rolls back migrations on a workstation, without the task queue:
+
+    zojax-migration-run --datastore path/to/datastore.db --app myapp myapp.models
+
+Modules given on the command line are imported to register their
+
+migrations with ``register_migrations``. The migrations run against the
+
+datastore stub, backed by the dev_appserver sqlite file given with
+
+``--datastore``, and sharded steps are mapped by ``--workers`` threads.
+"""
+
+import os
+import sys
+import time
+import optparse
+
+from .migrate import get_migration_dirs, read_migrations, next_migration_index, migrations_left, find_migration
+from .scheduler import blockers, check_cycles, DependencyError
+from .utils import prompt, plural
+
+
+def setup_stubs(app_id, datastore=None):
+    """
+    Activates the API stubs the migrations run against. Returns the testbed.
+    """
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    if datastore:
+        bed.init_datastore_v3_stub(datastore_file=datastore, use_sqlite=True)
+    else:
+        bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    return bed
+
+
+def get_plan(app_migrations, action, target=None):
+    """
+    Returns the migrations to apply (or roll back) on the way to migration
+
+    ``target``, the last (or the first) one by default, with its index.
+    """
+    if target is None:
+        index = len(app_migrations) - 1 if action == "apply" else 0
+    else:
+        index = app_migrations.index(target)
+    if action == "apply":
+        return index, list(app_migrations[:index + 1].to_apply())
+    return index, list(app_migrations[index:].to_rollback())
+
+
+def report_step(out):
+    def step_processed(index, recorder):
+        out.write("    step %d: %.2fs, %s, %d read / %d written\n" % (
+            index, recorder.duration, plural(recorder.rpcs, "%d RPC", "%d RPCs"),
+            recorder.reads, recorder.writes))
+    return step_processed
+
+
+def run(migrations, application, action, target_index, workers=1, out=sys.stdout):
+    """
+    Applies or rolls back migrations of ``application`` one by one in this
+
+    process, in the order the task chains would. Stops at a migration
+
+    waiting for migrations of another application. Returns the number of
+
+    processed migrations, raises the error of a failed one.
+    """
+    app_migrations = migrations[application]
+    processed = 0
+    index = next_migration_index(migrations, application, target_index, action)
+    while index is not None:
+        migration = app_migrations[index]
+        waiting = blockers(migrations, migration, action)
+        if waiting:
+            out.write("%s waits for %s\n" % (migration.id, ", ".join(
+                "%s:%s" % (m.application, m.id) for m, status in waiting)))
+            return processed
+        migration.inline = True
+        migration.workers = workers
+        migration.step_processed = report_step(out)
+        out.write("%s %s\n" % ("Applying" if action == "apply" else "Rolling back", migration.id))
+        started = time.time()
+        getattr(migration, action)()
+        out.write("  %s in %.2fs\n" % (migration.status, time.time() - started))
+        if migration.finished is None:
+            break
+        processed += 1
+        index = next_migration_index(migrations, application, target_index, action)
+
+    if action == "apply" and processed and index is None:
+        for hook in app_migrations.post_apply:
+            out.write("Running %s\n" % hook.id)
+            hook.step_processed = report_step(out)
+            hook.apply()
+    return processed
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options] module...",
+                                   description="Applies or rolls back the migrations registered by "
+                                               "the given modules against a local datastore.")
+    parser.add_option("--app", help="application to migrate, all registered ones by default")
+    parser.add_option("--rollback", action="store_true", default=False,
+                      help="roll back instead of applying")
+    parser.add_option("--target", help="id of the last migration to apply (or roll back)")
+    parser.add_option("--datastore", help="dev_appserver sqlite datastore file, in memory by default")
+    parser.add_option("--app-id", default=os.environ.get("APPLICATION_ID", "dev~migration"),
+                      help="application id of the datastore [%default]")
+    parser.add_option("--workers", type="int", default=4,
+                      help="threads mapping the shards of sharded steps [%default]")
+    parser.add_option("--yes", action="store_true", default=False,
+                      help="run without asking")
+    options, modules = parser.parse_args(argv)
+    action = "rollback" if options.rollback else "apply"
+
+    sys.path.insert(0, os.getcwd())
+    for module in modules:
+        __import__(module)
+    migrations = read_migrations(get_migration_dirs(), lazy=True)
+    applications = [options.app] if options.app else sorted(migrations)
+    if not applications or any(app not in migrations for app in applications):
+        parser.error("unknown application, registered are: %s" % (", ".join(sorted(migrations)) or "none"))
+    try:
+        check_cycles(migrations)
+    except DependencyError, e:
+        parser.error(str(e))
+
+    bed = setup_stubs(options.app_id, options.datastore)
+    try:
+        targets = {}
+        for app in applications:
+            target = None
+            if options.target:
+                target = find_migration(migrations[app], options.target)
+                if target is None:
+                    parser.error("%s has no migration %s" % (app, options.target))
+            targets[app], plan = get_plan(migrations[app], action, target)
+            print "%s: %s" % (app, plural(len(plan), "%d migration", "%d migrations"))
+            for migration in plan:
+                print "  %s %s" % (action, migration.id)
+        if not options.yes and prompt("Continue?", "yN") != "y":
+            return 1
+
+        # applications take turns until none of them makes progress, so
+        # migrations waiting for other applications run once those are done
+        processed = True
+        while processed:
+            processed = sum(run(migrations, app, action, targets[app], options.workers)
+                            for app in applications)
+        left = [app for app in applications
+                if migrations_left(migrations, app, targets[app], action)]
+        if left:
+            print >> sys.stderr, "Migrations of %s are left" % ", ".join(left)
+            return 1
+    finally:
+        bed.deactivate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from .migrate import MigrationLease, call_next, get_app_dependencies, app_prerequisites, find_migration, \
+    _dependency_graph
+
+
+logger = logging.getLogger(__name__)
+
+# cross-application dependency graph of the migrations it was last built for
+_graph_cache = [None]
+
+
+class DependencyError(Exception):
+    """
+    Raised for unknown or circular migration dependencies.
+    """
+    pass
+
+
+def resolve(migrations, spec, application):
+    """
+    Returns the list of migrations a dependency ``spec`` of a migration of
+
+    ``application`` refers to: "app" for all migrations of an application,
+
+    "app:id" for a single one, or "id" for a migration of ``application``.
+
+    Ids may be given with or without the .py extension.
+    """
+    if application in migrations and ":" not in spec:
+        migration = find_migration(migrations[application], spec)
+        if migration is not None:
+            return [migration]
+    app, sep, id = spec.partition(":")
+    if app not in migrations:
+        raise DependencyError("Unknown application '%s' in dependency '%s' of %s" % (app, spec, application))
+    if not sep:
+        return list(migrations[app])
+    migration = find_migration(migrations[app], id)
+    if migration is not None:
+        return [migration]
+    raise DependencyError("Unknown migration '%s' in dependency '%s' of %s" % (id, spec, application))
+
+
+def prerequisites(migrations, migration):
+    """
+    Returns migrations of other applications ``migration`` depends on,
+
+    declared by ``register_migrations(..., depends=...)`` for the whole
+
+    application or by the ``depends`` variable of the migration file.
+    """
+    graph = _cross_app_graph(migrations)
+    key = (migration.application, migration.id)
+    if key in graph['errors']:
+        raise graph['errors'][key]
+    if key not in graph['prerequisites']:
+        # not one of ``migrations``
+        return _resolve_prerequisites(migrations, migration)
+    return _lookup(migrations, graph['prerequisites'][key])
+
+
+def dependents(migrations, migration):
+    """
+    Returns migrations of other applications which depend on ``migration``.
+    """
+    graph = _cross_app_graph(migrations)
+    if graph['errors']:
+        raise graph['errors'][min(graph['errors'])]
+    return _lookup(migrations, graph['dependents'].get((migration.application, migration.id), []))
+
+
+def _lookup(migrations, keys):
+    # migrations of ``migrations`` by their (application, id)
+    return [migrations[app][_dependency_graph(migrations[app])['index'][id]] for app, id in keys]
+
+
+def _resolve_prerequisites(migrations, migration):
+    specs = list(get_app_dependencies().get(migration.application, []))
+    specs.extend(migration.depends or [])
+    result, seen = [], set()
+    for spec in specs:
+        for prerequisite in resolve(migrations, spec, migration.application):
+            key = (prerequisite.application, prerequisite.id)
+            if prerequisite.application != migration.application and key not in seen:
+                seen.add(key)
+                result.append(prerequisite)
+    return result
+
+
+def _cross_app_graph(migrations):
+    # (application, id) of prerequisites and dependents in other applications of
+    # the migrations, built once for the same migrations and dependencies, which
+    # are read again for every request
+    app_dependencies = get_app_dependencies()
+    signature = sorted(
+        (app, tuple(app_dependencies.get(app, ())),
+         [(migration.application, migration.id, tuple(migration.depends or ())) for migration in app_migrations])
+        for app, app_migrations in migrations.items())
+    cached = _graph_cache[0]
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    graph = {'prerequisites': {}, 'dependents': {}, 'errors': {}, 'acyclic': False}
+    for app_migrations in migrations.values():
+        for migration in app_migrations:
+            graph['dependents'][(migration.application, migration.id)] = []
+    for app_migrations in migrations.values():
+        for migration in app_migrations:
+            key = (migration.application, migration.id)
+            try:
+                result = _resolve_prerequisites(migrations, migration)
+            except DependencyError, e:
+                # raised when the migration is asked about
+                graph['errors'][key] = e
+                continue
+            graph['prerequisites'][key] = [(prerequisite.application, prerequisite.id) for prerequisite in result]
+            for prerequisite in result:
+                graph['dependents'][(prerequisite.application, prerequisite.id)].append(key)
+
+    _graph_cache[0] = (signature, graph)
+    return graph
+
+
+def blockers(migrations, migration, action):
+    """
+    Returns migrations which have to be applied (for ``action`` "apply") or
+
+    rolled back (for "rollback") before ``migration``, with their statuses.
+    """
+    if action == "apply":
+        related = prerequisites(migrations, migration)
+        done = ("apply success",)
+    else:
+        related = dependents(migrations, migration)
+        done = ("new", "rollback success")
+
+    statuses = {}
+    for app in set(m.application for m in related):
+        statuses[app] = migrations[app].statuses()
+    return [(m, statuses[m.application][m.id]) for m in related
+            if statuses[m.application][m.id] not in done]
+
+
+def check_cycles(migrations):
+    """
+    Raises DependencyError if dependencies of the migrations are circular.
+
+    Migrations without ``depends`` depend on the previous migration of their
+
+    application. The result is kept with the dependency graph.
+    """
+    graph = _cross_app_graph(migrations)
+    if graph['acyclic']:
+        return
+    visiting, visited = set(), set()
+    path = []
+
+    def visit(migration):
+        key = (migration.application, migration.id)
+        if key in visited:
+            return
+        if key in visiting:
+            raise DependencyError("Circular migration dependencies: %s" %
+                                  " -> ".join("%s:%s" % (m.application, m.id) for m in path + [migration]))
+        visiting.add(key)
+        path.append(migration)
+        app_migrations = migrations[migration.application]
+        for prerequisite in app_prerequisites(app_migrations, migration) + \
+                prerequisites(migrations, migration):
+            visit(prerequisite)
+        path.pop()
+        visiting.discard(key)
+        visited.add(key)
+
+    for app_migrations in migrations.values():
+        for migration in app_migrations:
+            visit(migration)
+    graph['acyclic'] = True
+
+
+def start_all(migrations, action, worker_url, ttl, params=None):
+    """
+    Starts a chain of migrations to ``action`` for every application, to
+
+    run in parallel. Chains hold migrations until migrations of other
+
+    applications they depend on are applied (or their dependents are rolled
+
+    back). Returns a dict of applications to the started chain ids, None for
+
+    applications another chain is running for.
+    """
+    check_cycles(migrations)
+    started = {}
+    for app, app_migrations in migrations.items():
+        if not app_migrations:
+            continue
+        chain = MigrationLease.new_chain()
+        target_index = len(app_migrations) - 1 if action == "apply" else 0
+        lease = MigrationLease.acquire(app, chain, ttl, action, str(target_index))
+        if lease.chain != chain:
+            logger.warning("Migrations of %s are being processed by another chain", app)
+            started[app] = None
+            continue
+        call_next(migrations, app, target_index, action, worker_url, dict(params or {}, chain=chain))
+        started[app] = chain
+    return started
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_local = threading.local()
+
+
+def _recorders():
+    if not hasattr(_local, 'recorders'):
+        _local.recorders = []
+    return _local.recorders
+
+
+def _post_call_hook(service, call, request, response):
+    for recorder in _recorders():
+        recorder.record(call, request, response)
+
+
+def install_hooks():
+    """
+    Installs the datastore RPC hooks. Safe to call repeatedly, also after
+
+    the API proxy has been replaced (e.g. by testbed).
+    """
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'zojax.gae.migration.stats', _post_call_hook, 'datastore_v3')
+
+
+def record_writes(count, call=None):
+    """
+    Records entity writes that didn't reach the datastore (see ``dryrun``),
+
+    and the ``call`` RPC that would have sent them.
+    """
+    for recorder in _recorders():
+        recorder.writes += count
+        if call is not None:
+            recorder.calls[call] = recorder.calls.get(call, 0) + 1
+
+
+def add_recorded(other):
+    """
+    Adds what recorder ``other`` recorded, e.g. in another thread, to the
+
+    active recorders of the current thread.
+    """
+    for recorder in _recorders():
+        for call, calls in other.calls.items():
+            recorder.calls[call] = recorder.calls.get(call, 0) + calls
+        recorder.reads += other.reads
+        recorder.writes += other.writes
+
+
+class Recorder(object):
+    """
+    Counts datastore RPCs and entities read and written by the current
+
+    thread while the recorder is active, and the time it was active for.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.reads = 0
+        self.writes = 0
+        self.duration = 0.0
+        self.started = None
+
+    @property
+    def rpcs(self):
+        return sum(self.calls.values())
+
+    def __enter__(self):
+        install_hooks()
+        _recorders().append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.duration += time.time() - self.started
+        _recorders().remove(self)
+
+    def record(self, call, request, response):
+        self.calls[call] = self.calls.get(call, 0) + 1
+        if call == 'Get':
+            self.reads += len([e for e in response.entity_list() if e.has_entity()])
+        elif call in ('RunQuery', 'Next'):
+            self.reads += response.result_size()
+        elif call == 'Put':
+            self.writes += request.entity_size()
+        elif call == 'Delete':
+            self.writes += request.key_size()
+
+    def as_dict(self):
+        return {'rpcs': self.rpcs,
+                'calls': dict(self.calls),
+                'reads': self.reads,
+                'writes': self.writes,
+                'duration': self.duration,
+                }
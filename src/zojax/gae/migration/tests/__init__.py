@@ -2,6 +2,8 @@
 
 import re
 import os
+import time
+import json
 import urlparse
 import random
 import string
@@ -9,15 +11,18 @@ import string
 from unittest import TestCase
 
 from google.appengine.ext import testbed
+from google.appengine.api import datastore_errors, taskqueue
 from webapp2 import WSGIApplication
 
 from webtest import TestApp
 
+import ndb
 from ndb import model
 
 from .. import migrate
 
 from ..migrate import read_migrations, register_migrations, get_migration_dirs
+from ..mapper import Mapper, Throttle, split_key_ranges
 
 from ..routes import routes
 
@@ -119,6 +124,129 @@ class MigrationsTestCase(BaseTestCase):
         # we should have 4 test migrations
         self.assertEqual(len(self.migrations_dict['zojax.gae.migration']), 4)
 
+    def testMigrationsCache(self):
+        # parsed migrations are shared between read_migrations calls
+        migrations = read_migrations(get_migration_dirs())['zojax.gae.migration']
+        self.assertTrue(migrations[0].steps is self.migrations[0].steps)
+        # but migration objects are not
+        self.assertFalse(migrations[0] is self.migrations[0])
+        # changed file is parsed again
+        path = os.path.join(os.path.dirname(__file__), 'migrations', '0003.test_migration.py')
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+        try:
+            migrations = read_migrations(get_migration_dirs())['zojax.gae.migration']
+        finally:
+            os.utime(path, (stat.st_atime, stat.st_mtime))
+        self.assertFalse(migrations[2].steps is self.migrations[2].steps)
+        self.assertTrue(migrations[3].steps is self.migrations[3].steps)
+        # forced reload
+        migrations = read_migrations(get_migration_dirs(), reload=True)['zojax.gae.migration']
+        self.assertFalse(migrations[3].steps is self.migrations[3].steps)
+
+    def testCodeCache(self):
+        path = self.migrations[0].path
+        source, hash = migrate._read_source(path)
+        code = migrate._compile_migration(path, source, hash)
+        self.assertTrue(migrate._compile_migration(path, source, hash) is code)
+        # a cold instance loads the code from memcache
+        migrate._CODE_CACHE.clear()
+        self.assertEqual(migrate._load_code(path, hash).co_code, code.co_code)
+        self.assertEqual(migrate._load_code(path, 'changed'), None)
+        # or from the files compiled at build time
+        written = migrate.write_code_cache(get_migration_dirs())
+        try:
+            migrate.memcache.flush_all()
+            self.assertEqual(migrate._load_code(path, hash).co_code, code.co_code)
+        finally:
+            for code_path in written:
+                os.remove(code_path)
+
+    def testManifest(self):
+        from ..manifest import write_manifests, check_manifest
+
+        written = write_manifests(get_migration_dirs())
+        try:
+            migrations = read_migrations(get_migration_dirs(), lazy=True)['zojax.gae.migration']
+            self.assertEqual([(m.id, m.hash) for m in migrations],
+                             [(m.id, m.hash) for m in self.migrations])
+            # described by the manifest, sources are not read
+            self.assertTrue(migrations[0]._source is None)
+            self.assertTrue(migrations[0].source)
+            dir = os.path.dirname(written[0])
+            # modification times are not compared, deployments don't keep them
+            path = migrations[0].path
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+            self.assertTrue(migrate.read_manifest(dir) is not None)
+            # files edited in place make it stale
+            source = open(path).read()
+            try:
+                open(path, 'w').write(source + "\n")
+                self.assertEqual(migrate.read_manifest(dir), None)
+                # an edit keeping the size is noticed when the file is read
+                open(path, 'w').write(source[:-1] + "#")
+                self.assertTrue(migrate.read_manifest(dir) is not None)
+                described = read_migrations(get_migration_dirs(), lazy=True)['zojax.gae.migration'][0]
+                self.assertTrue(described._source is None)
+                self.assertTrue(described.source.endswith("#"))
+                self.assertEqual(migrate.read_manifest(dir), None)
+            finally:
+                open(path, 'w').write(source)
+            # as well as files added after it
+            added = os.path.join(dir, '0005.added.py')
+            open(added, 'w').close()
+            try:
+                self.assertEqual(migrate.read_manifest(dir), None)
+            finally:
+                os.remove(added)
+        finally:
+            for path in written:
+                os.remove(path)
+
+        files = [{'id': id, 'post_apply': False} for id in ('0001_a', '0002_b', '0002_c', '010_d', '0003_e')]
+        self.assertEqual(check_manifest({'files': files}),
+                         ['0002_b and 0002_c have the same number', '0003_e is applied after 010_d'])
+
+    def testRunner(self):
+        from StringIO import StringIO
+        from ..runner import get_plan, run
+
+        index, plan = get_plan(self.migrations, 'apply')
+        self.assertEqual(index, 3)
+        self.assertEqual([m.id for m in plan], [m.id for m in self.migrations])
+        out = StringIO()
+        self.assertEqual(run(self.migrations_dict, 'zojax.gae.migration', 'apply', index, out=out), 4)
+        self.assertTrue(all(m.isapplied(ready_only=True) for m in self.migrations))
+        self.assertTrue('step 0:' in out.getvalue())
+        # nothing is left to apply
+        self.assertEqual(run(self.migrations_dict, 'zojax.gae.migration', 'apply', index, out=out), 0)
+
+    def testRunnerShards(self):
+        # shards of sharded steps are mapped by threads
+        def rename(article):
+            article.title = "renamed"
+            return article
+
+        migration = self.migrations[2]
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(0, Mapper(TestArticle.query(), rename, 10, shards=4), None)])]
+        migration.inline = True
+        migration.workers = 2
+        migration.apply()
+        self.assertEqual(migration.status, 'apply success')
+        self.assertEqual(TestArticle.query(TestArticle.title == "renamed").count(), 100)
+
+    def testLazyMigrations(self):
+        migrations = read_migrations(get_migration_dirs(), lazy=True)['zojax.gae.migration']
+        self.assertEqual(len(migrations), 4)
+        migration = migrations[0]
+        # only metadata is read
+        self.assertTrue(migration._steps is None)
+        self.assertEqual(migration.hash, self.migrations[0].hash)
+        self.assertEqual(migration.path, self.migrations[0].path)
+        # steps are executed on demand
+        self.assertEqual(len(migration.steps), 2)
+
     def testMigrationList(self):
         # currently self.migrations is instance of MigrationList and
         # contains unapplied migrations
@@ -132,6 +260,332 @@ class MigrationsTestCase(BaseTestCase):
                          set([('action', 'apply'),('index', '0'), ('app', 'zojax.gae.migration')])
                         )
 
+    def testStatuses(self):
+        migration = self.migrations[0]
+        self.assertEqual(migration.key,
+                         migration.migration_model.key_for('zojax.gae.migration', migration.id))
+        self.assertEqual(self.migrations.statuses(),
+                         dict((m.id, 'new') for m in self.migrations))
+        migration.migration_model(key=migration.key, id=migration.id,
+                                  application=migration.application,
+                                  status='apply success').put()
+        statuses = self.migrations.statuses()
+        self.assertEqual(statuses[migration.id], 'apply success')
+        self.assertEqual(statuses[self.migrations[1].id], 'new')
+        self.assertEqual(len(self.migrations.to_apply()), 3)
+        self.assertEqual(list(self.migrations.to_rollback()), [migration])
+
+    def testStatusSnapshot(self):
+        migration = self.migrations[0]
+        model = migration.migration_model
+        self.assertEqual(migration.status, 'new')
+        generation = migrate.get_status_generation(model, migration.application)
+        # snapshot is served without datastore reads
+        self.assertEqual(migrate.get_statuses(model, migration.application, [migration.id]),
+                         {migration.id: 'new'})
+        # put hook moves the snapshot to the next generation
+        model(key=migration.key, id=migration.id, application=migration.application,
+              status='apply in process').put()
+        self.assertNotEqual(migrate.get_status_generation(model, migration.application), generation)
+        self.assertEqual(migration.status, 'apply in process')
+        # as well as delete hook
+        migration.key.delete()
+        self.assertEqual(migration.status, 'new')
+
+    def testTransition(self):
+        migration = self.migrations[0]
+        # wrong source status
+        self.assertFalse(migration.transition('apply in process', 'apply success'))
+        self.assertEqual(migration.status, 'new')
+        self.assertTrue(migration.transition('new', 'apply in process'))
+        # status is changed right away
+        self.assertEqual(migration.status, 'apply in process')
+        self.assertFalse(migration.transition('new', 'apply in process'))
+        migration.fail()
+        self.assertEqual(migration.status, 'apply failed')
+        self.assertTrue(migration.transition('apply failed', 'rollback success'))
+        self.assertEqual(migration.key.get(), None)
+        # no status tasks are queued
+        self.assertEqual(len(self.get_tasks()), 0)
+        # within a transaction statuses are invalidated once more after the commit
+        other = self.migrations[1]
+        generations = []
+
+        def txn():
+            other.transition('new', 'apply in process')
+            generations.append(migrate.get_status_generation(other.migration_model, other.application))
+
+        ndb.transaction(txn)
+        self.assertNotEqual(migrate.get_status_generation(other.migration_model, other.application),
+                            generations[0])
+        self.assertEqual(other.status, 'apply in process')
+
+    def testLegacyEntries(self):
+        migrate._REKEYED.clear()
+        model = migrate.MigrationEntry
+        # entries of earlier versions have automatic ids
+        applied, failed = self.migrations[0], self.migrations[1]
+        model(key=model.Key(model, 11), id=applied.id, application=applied.application,
+              status='apply success').put()
+        model(key=model.Key(model, 12), id=failed.id, application=failed.application,
+              status='apply in process').put()
+        statuses = self.migrations.statuses()
+        self.assertEqual(statuses[applied.id], 'apply success')
+        self.assertEqual(statuses[failed.id], 'apply in process')
+        # and are moved to the deterministic keys
+        self.assertEqual(model.get_by_id(11), None)
+        self.assertEqual(applied.key.get().legacy_id, 11)
+        self.assertEqual(len(self.migrations.to_apply()), 2)
+        # the scan runs once per application, not once per instance
+        self.assertNotEqual(migrate.RekeyMarker.get_by_id('%s/%s' % (model._get_kind(), applied.application)), None)
+        migrate._REKEYED.clear()
+        migrate.memcache.flush_all()
+        self.assertFalse(model.rekey_legacy(applied.application))
+        # status tasks queued by earlier versions carry the automatic id
+        self.app.post('/_ah/migration/tasks/status/', {'id': '12', 'status': 'apply failed'})
+        self.assertEqual(failed.status, 'apply failed')
+
+    def testMapper(self):
+        def rename(article):
+            if article.title.endswith("0"):
+                return article.key
+            article.title = article.title.upper()
+            return article
+
+        Mapper(TestArticle.query(), rename, batch_size=7)(None)
+        self.assertEqual(TestArticle.query().count(), 90)
+        for article in TestArticle.query():
+            self.assertTrue(article.title.startswith("BEAUTIFUL ARTICLE"))
+
+    def testTaskletMapper(self):
+        @ndb.tasklet
+        def rate(article):
+            article.rating = 5
+            raise ndb.Return(article)
+
+        TestArticle.add_property("rating", model.IntegerProperty)
+        Mapper(TestArticle.query(), rate, batch_size=30)(None).get_result()
+        self.assertEqual(TestArticle.query(TestArticle.rating == 5).count(), 100)
+
+    def testShards(self):
+        ranges = split_key_ranges(TestArticle.query(), 4)
+        self.assertTrue(1 <= len(ranges) <= 4)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        # ranges cover all entities exactly once
+        seen = []
+        mapper = Mapper(TestArticle.query(), lambda article: seen.append(article.key))
+        for start, end in ranges:
+            mapper.run(None, start=start, end=end)
+        self.assertEqual(sorted(seen), sorted(TestArticle.query().fetch(keys_only=True)))
+        # fan-in fires once, for the last shard only
+        migration = self.migrations[0]
+        model = migration.migration_model
+        model(key=migration.key, id=migration.id, application=migration.application,
+              status='apply in process', pending_shards=['0/0', '0/1']).put()
+        self.assertFalse(model.finish_shard(migration.application, migration.id, '0/0'))
+        self.assertFalse(model.finish_shard(migration.application, migration.id, '0/0'))
+        self.assertTrue(model.finish_shard(migration.application, migration.id, '0/1'))
+        self.assertFalse(model.finish_shard(migration.application, migration.id, '0/1'))
+        # the step checkpoint is saved with the pending shards, before shard tasks start
+        migration = self.migrations[1]
+        migration.transition('new', 'apply in process')
+        migration.direction = 'apply'
+        migration.step_index = 1
+        self.assertRaises(migrate.StepDeferred, migration.fan_out, [(None, None)])
+        entry = migration.key.get()
+        self.assertEqual((entry.step, entry.pending_shards), (1, ['1/0']))
+        self.assertEqual(len(self.get_tasks()), 1)
+        # a duplicate task of a finished shard doesn't map its range again
+        mapped = []
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(i, Mapper(TestArticle.query(), mapped.append, 10, shards=2), None)])
+                           for i in range(2)]
+        model.finish_shard(migration.application, migration.id, '1/0')
+        migration.run_shard('apply', '1/0')
+        self.assertEqual(mapped, [])
+
+    def testThrottle(self):
+        throttle = Throttle(target_latency=0.5, step=0.01, factor=2.0, max_delay=0.08)
+        throttle.observe(0.1)
+        self.assertEqual(throttle.delay, 0)
+        throttle.observe(1.0)
+        self.assertEqual(throttle.delay, 0.01)
+        throttle.contended()
+        self.assertEqual(throttle.delay, 0.02)
+        for i in range(5):
+            throttle.contended()
+        self.assertEqual(throttle.delay, 0.08)
+        throttle.observe(0.1)
+        self.assertEqual(throttle.delay, 0.07)
+
+        # batches failed with contention errors are written again
+        def rename(article):
+            article.title = "renamed"
+            return article
+
+        failed = []
+        put_multi_async = ndb.put_multi_async
+
+        def contended_put_multi_async(entities, **kwargs):
+            if not failed:
+                failed.append(entities)
+                future = ndb.Future()
+                future.set_exception(datastore_errors.Timeout())
+                return [future]
+            return put_multi_async(entities, **kwargs)
+
+        ndb.put_multi_async = contended_put_multi_async
+        try:
+            Mapper(TestArticle.query(), rename, 10, throttle=throttle)(None)
+        finally:
+            ndb.put_multi_async = put_multi_async
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(TestArticle.query(TestArticle.title == "renamed").count(), 100)
+        # batches written fast enough speed the mapper up again
+        self.assertEqual(throttle.delay, 0)
+
+        # new entities of a batch committed before its RPC failed are not added twice
+        def copy(article):
+            return TestArticle(title="copy")
+
+        def committed_put_multi_async(entities, **kwargs):
+            if not failed:
+                failed.append(entities)
+                ndb.put_multi([TestArticle(key=entity.key, title=entity.title) for entity in entities])
+                future = ndb.Future()
+                future.set_exception(datastore_errors.Timeout())
+                return [future]
+            return put_multi_async(entities, **kwargs)
+
+        del failed[:]
+        ndb.put_multi_async = committed_put_multi_async
+        try:
+            Mapper(TestArticle.query(TestArticle.title == "renamed"), copy, 10, throttle=throttle)(None)
+        finally:
+            ndb.put_multi_async = put_multi_async
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(TestArticle.query(TestArticle.title == "copy").count(), 100)
+
+    def testTaskOptions(self):
+        try:
+            migrate.configure_tasks({'queue_name': 'default', 'task_retry': {'task_retry_limit': 2}})
+            migrate._enqueue('/worker/', {'index': 0})
+            self.assertEqual(len(self.get_tasks()), 1)
+            migrate.configure_tasks({'queue_name': 'migrations'})
+            self.assertRaises(taskqueue.UnknownQueueError, migrate._enqueue, '/worker/', {'index': 0})
+        finally:
+            migrate.configure_tasks(migrate.default_config)
+
+    def testResume(self):
+        migration = self.migrations[2]
+        model = migration.migration_model
+        steps = []
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(i, lambda m, i=i: steps.append(i), None)])
+                           for i in range(3)]
+        # a task died after the 1st step
+        model(key=migration.key, id=migration.id, application=migration.application,
+              status='apply in process', step=1).put()
+        migration.apply()
+        self.assertEqual(steps, [1, 2])
+        self.assertEqual(migration.status, 'apply success')
+        # nothing to resume
+        migration.apply()
+        self.assertEqual(steps, [1, 2])
+
+    def testDeadline(self):
+        migration = self.migrations[2]
+        steps = []
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(i, lambda m, i=i: steps.append(i), None)])
+                           for i in range(3)]
+        migration.deadline = time.time() - 1
+        migration.apply()
+        # at least one step is processed per task
+        self.assertEqual(steps, [0])
+        self.assertEqual(migration.status, 'apply in process')
+        self.assertEqual(migration.key.get().step, 1)
+        # continuation task is queued
+        tasks = self.get_tasks()
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0]["url"], migrate.WORKER_URL)
+        migration.deadline = None
+        migration.apply()
+        self.assertEqual(steps, [0, 1, 2])
+        # metrics of all steps are recorded, the resumed step counts a retry
+        metrics = migration.key.get().metrics
+        self.assertEqual([(m.step, m.direction) for m in metrics],
+                         [(0, 'apply'), (1, 'apply'), (2, 'apply')])
+        self.assertEqual([m.retries for m in metrics], [0, 1, 0])
+
+    def testRunHistory(self):
+        migration = self.migrations[2]
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(i, lambda m: None, lambda m: None)])
+                           for i in range(2)]
+        migration.apply()
+        migration.rollback()
+        self.assertEqual(migration.key.get(), None)
+        # metrics of both runs outlive the entry
+        runs = model.get_multi([migrate.MigrationRun.key_for(migration.key, direction)
+                                for direction in ('apply', 'rollback')])
+        self.assertEqual([(run.direction, run.status) for run in runs],
+                         [('apply', 'apply success'), ('rollback', 'rollback success')])
+        self.assertEqual([m.step for m in runs[1].metrics], [0, 1])
+        self.assertEqual(migrate.MigrationRun.last(runs).direction, 'rollback')
+
+        # steps finishing the migration with succeed() are recorded after the run is stored
+        migration = self.migrations[2]
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(0, lambda m: None, lambda m: None)]),
+                           migrate.Transaction([migrate.MigrationStep(1, lambda m: m.succeed(), lambda m: m.succeed())])]
+        migration.apply()
+        migration.rollback()
+        self.assertEqual(migration.key.get(), None)
+        runs = model.get_multi([migrate.MigrationRun.key_for(migration.key, direction)
+                                for direction in ('apply', 'rollback')])
+        self.assertEqual([sorted(m.step for m in run.metrics) for run in runs], [[0, 1], [0, 1]])
+
+    def testDryRun(self):
+        def rename(article):
+            article.title = "renamed"
+            return article
+
+        migration = self.migrations[2]
+        migration.steps = [migrate.Transaction([migrate.MigrationStep(0, Mapper(TestArticle.query(), rename, 10), None)])]
+        migration.sample_batches = 2
+        report = migration.apply(dry_run=True)
+        # nothing is committed
+        self.assertEqual(TestArticle.query(TestArticle.title == "renamed").count(), 0)
+        self.assertEqual(migration.status, 'new')
+        (step,) = report['steps']
+        self.assertEqual(step['sampled'], 20)
+        self.assertEqual(step['total'], 100)
+        self.assertEqual(step['writes'], 20)
+        # a Put RPC per written batch is counted as well
+        self.assertEqual(step['calls'].get('Put'), 2)
+        self.assertEqual(report['estimated']['writes'], 100)
+        # the migration is left as it was
+        self.assertFalse(migration.dry_run)
+        self.assertTrue(migration.sharding)
+        self.assertTrue(migration.checkpoints)
+        self.assertEqual(migration.sample_batches, 2)
+        # estimate action
+        res = self.app.get('/_ah/migration/tasks/migrate/?%s' % self.migrations.url_query_for('dryrun', self.migrations[3]))
+        self.assertEqual(json.loads(res.body)['migration'], self.migrations[3].id)
+
+    def testBenchmark(self):
+        from .benchmark import run_benchmarks, compare
+        results = run_benchmarks([20], [10], batch_size=7)
+        self.assertEqual([r['scenario'] for r in results],
+                         ['add_property', 'transform', 'rollback', 'delete'])
+        for result in results:
+            # migration entry bookkeeping is included
+            self.assertTrue(result['writes'] >= 20)
+            self.assertTrue(result['rpcs_per_entity'] > 0)
+            # memory is measured per scenario
+            self.assertTrue(result['memory_kb'] is None or result['memory_kb'] >= 0)
+        # same results are not a regression, halved throughput is
+        self.assertEqual(compare(results, results, 0.2), [])
+        slower = [dict(r, entities_per_second=r['entities_per_second'] / 2) for r in results]
+        self.assertEqual(len(compare(slower, results, 0.2)), 4)
+
     def testFullApply(self):
         # Check apllying process
         # /_ah/migration/migrate/?action=rollback&index=3&app=inboxer
@@ -142,6 +596,241 @@ class MigrationsTestCase(BaseTestCase):
         # test 4 migrations applied successfully
         applied = target_migration.migration_model.query(target_migration.migration_model.status == 'apply success')
         self.assertEqual(applied.count(), 4)
+        # 1st migration put 100 articles in each of its steps
+        metrics = self.migrations[0].key.get().metrics
+        self.assertEqual(len(metrics), 2)
+        self.assertTrue(all(m.writes == 100 and m.rpcs > 0 for m in metrics))
+        self.assertContains(self.app.get('/_ah/migration/'), 'apply #1')
+
+    def testStatusAPI(self):
+        app = self.migrations[0].application
+        res = self.app.get('/_ah/migration/status.json')
+        self.assertEqual(res.content_type, 'application/json')
+        data = json.loads(res.body)[app]
+        self.assertEqual(data['applied'], 0)
+        self.assertEqual(data['total'], len(self.migrations))
+        self.assertEqual(data['migrations'][0], {'id': self.migrations[0].id, 'status': 'new'})
+        etag = res.headers['ETag']
+        # unchanged statuses are not sent again
+        res = self.app.get('/_ah/migration/status.json', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_int, 304)
+        self.migrations[0].apply()
+        res = self.app.get('/_ah/migration/status.json?app=%s' % app, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(json.loads(res.body)[app]['applied'], 1)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def testProgress(self):
+        migration = self.migrations[0]
+        migration.transition("new", "apply in process")
+        migration.direction = "apply"
+        migration.set_progress_total(200)
+        migration.progress(50)
+        migration.progress(50)
+        # the counters are stored at most every progress_flush_interval seconds
+        self.assertEqual(migration.key.get().progress_done, 0)
+        progress = migration.get_progress()
+        self.assertEqual((progress['done'], progress['total'], progress['percent']), (100, 200, 50.0))
+        self.assertTrue(progress['eta'] >= 0)
+        migration.flush_progress()
+        self.assertEqual(migration.key.get().progress_done, 100)
+
+        res = self.app.get('/_ah/migration/status.json')
+        data = json.loads(res.body)[migration.application]['migrations'][0]
+        self.assertEqual(data['progress']['done'], 100)
+        self.assertContains(self.app.get('/_ah/migration/'), '100 / 200 (50.0%)')
+        # evicted counters fall back to the stored progress
+        migrate.memcache.flush_all()
+        data = json.loads(self.app.get('/_ah/migration/status.json').body)
+        self.assertEqual(data[migration.application]['migrations'][0]['progress']['total'], 200)
+        # single items are added up locally and sent with the next batch or flush
+        migration.progress()
+        self.assertEqual(migration.progress_pending, 1)
+        migration.flush_progress()
+        self.assertEqual(migration.progress_pending, 0)
+        # shard tasks leave storing the counters to the task finishing the last shard
+        migration.progress_started = False
+        migration.shard = ('0/0', None, None)
+        migration.progress(100)
+        migration.flush_progress()
+        self.assertEqual(migration.key.get().progress_done, 100)
+        migration.shard = None
+        # a failed store doesn't fail the migration
+        def set_progress(*args, **kwargs):
+            raise datastore_errors.TransactionFailedError()
+        stored = migration.migration_model.__dict__['set_progress']
+        migration.migration_model.set_progress = staticmethod(set_progress)
+        try:
+            migration.progress(10)
+            migration.flush_progress()
+        finally:
+            migration.migration_model.set_progress = stored
+        self.assertEqual(migration.progress_pending, 0)
+        self.assertEqual(migration.get_progress()['done'], 111)
+
+    def testLease(self):
+        target_migration = self.migrations[3]
+        url = '/_ah/migration/tasks/migrate/?%s' % self.migrations.url_query_for('apply', target_migration)
+        self.assertEqual(self.app.get(url).status_int, 302)
+        # a repeated click joins the running chain
+        self.assertEqual(self.app.get(url).status_int, 302)
+        self.assertEqual(len(self.get_tasks()), 1)
+        # a different chain is rejected
+        other = '/_ah/migration/tasks/migrate/?%s' % self.migrations.url_query_for('apply', self.migrations[1])
+        self.assertEqual(self.app.get(other, status=409).status_int, 409)
+        # tasks of a chain that lost the lease are dropped
+        self.app.post('/_ah/migration/tasks/worker/', {'application': target_migration.application,
+                                                       'action': 'apply', 'index': 0, 'target_index': 3,
+                                                       'chain': 'stale'})
+        self.assertEqual(target_migration.migration_model.query().count(), 0)
+        self.submit_deferred()
+        self.assertTrue(target_migration.isapplied())
+        # the lease is released once the chain is complete
+        self.assertEqual(migrate.MigrationLease.query().count(), 0)
+        url = '/_ah/migration/tasks/migrate/?%s' % self.migrations.url_query_for('rollback', self.migrations[0])
+        self.assertEqual(self.app.get(url).status_int, 302)
+
+    def testDependencies(self):
+        from ..scheduler import DependencyError, blockers, check_cycles
+
+        def migration(app, id, depends=None):
+            return migrate.Migration(id, [], '', application=app,
+                                     metadata={'depends': depends} if depends else None)
+
+        migrations = {
+            'a': migrate.MigrationList(migrate.MigrationEntry, [migration('a', '0001.py'), migration('a', '0002.py')]),
+            'b': migrate.MigrationList(migrate.MigrationEntry, [migration('b', '0001.py', ['a:0002'])]),
+        }
+        a1, a2 = migrations['a']
+        b1 = migrations['b'][0]
+        check_cycles(migrations)
+        # the graph is kept for migrations read again, and refers to the ones asked about
+        from ..scheduler import _cross_app_graph, dependents
+        graph = _cross_app_graph(migrations)
+        again = dict((app, migrate.MigrationList(migrate.MigrationEntry, [migration(m.application, m.id, m.depends)
+                                                                          for m in app_migrations]))
+                     for app, app_migrations in migrations.items())
+        self.assertTrue(_cross_app_graph(again) is graph)
+        self.assertTrue(dependents(again, again['a'][1])[0] is again['b'][0])
+        self.assertEqual(blockers(migrations, b1, 'apply'), [(a2, 'new')])
+        self.assertEqual(blockers(migrations, a1, 'apply'), [])
+        a2.transition('new', 'apply success')
+        self.assertEqual(blockers(migrations, b1, 'apply'), [])
+        b1.transition('new', 'apply success')
+        # dependents are rolled back first
+        self.assertEqual(blockers(migrations, a2, 'rollback'), [(b1, 'apply success')])
+
+        a1.depends = ['b']
+        self.assertRaises(DependencyError, check_cycles, migrations)
+        a1.depends = ['c']
+        self.assertRaises(DependencyError, blockers, migrations, a1, 'apply')
+
+    def testDAG(self):
+        def migration(id, depends=None):
+            return migrate.Migration(id, [], '', application='dag',
+                                     metadata={'depends': depends} if depends is not None else None)
+
+        dag = migrate.MigrationList(migrate.MigrationEntry, [migration('0001.py'), migration('0002.py', []),
+                                                             migration('0003.py', ['0001', '0002.py']),
+                                                             migration('0004.py')])
+        migrations = {'dag': dag}
+        m1, m2, m3, m4 = dag
+        self.assertEqual(migrate.ready_migration_indexes(migrations, 'dag', 3, 'apply'), [0, 1])
+        migrate.call_next(migrations, 'dag', 3, 'apply', '/_ah/migration/tasks/worker/', {'chain': 'c1'})
+        migrate.call_next(migrations, 'dag', 3, 'apply', '/_ah/migration/tasks/worker/', {'chain': 'c1'})
+        # independent migrations are started in parallel, once
+        self.assertEqual(len(self.get_tasks()), 2)
+
+        m1.transition('new', 'apply success')
+        self.assertEqual(migrate.call_next(migrations, 'dag', 3, 'apply', '/_ah/migration/tasks/worker/',
+                                           {'chain': 'c1'}, after=m1, inline=True), None)
+        m2.transition('new', 'apply success')
+        # 0003 waits for two migrations, so it is started in a named task
+        self.assertEqual(migrate.call_next(migrations, 'dag', 3, 'apply', '/_ah/migration/tasks/worker/',
+                                           {'chain': 'c1'}, after=m2, inline=True), None)
+        self.assertEqual(len(self.get_tasks()), 3)
+        m3.transition('new', 'apply success')
+        self.assertEqual(migrate.call_next(migrations, 'dag', 3, 'apply', '/_ah/migration/tasks/worker/',
+                                           {'chain': 'c1'}, after=m3, inline=True), 3)
+        m4.transition('new', 'apply success')
+
+        # rollbacks go in reverse topological order
+        self.assertEqual(migrate.ready_migration_indexes(migrations, 'dag', 0, 'rollback'), [3])
+        m4.transition('apply success', 'rollback success')
+        self.assertEqual(migrate.ready_migration_indexes(migrations, 'dag', 0, 'rollback'), [2])
+        m3.transition('apply success', 'rollback success')
+        self.assertEqual(migrate.ready_migration_indexes(migrations, 'dag', 0, 'rollback'), [1, 0])
+
+        # dependencies on other applications keep the previous migration as a prerequisite
+        dag = migrate.MigrationList(migrate.MigrationEntry, [migration('0001'), migration('0002', ['other:0001']),
+                                                             migration('0003', ['other', 'dag:0001'])])
+        self.assertEqual([m.id for m in migrate.app_prerequisites(dag, dag[1])], ['0001'])
+        self.assertEqual([m.id for m in migrate.app_prerequisites(dag, dag[2])], ['0001'])
+        self.assertEqual([m.id for m in migrate.app_dependents(dag, dag[0])], ['0002', '0003'])
+        self.assertEqual(migrate.ready_migration_indexes({'dag': dag}, 'dag', 2, 'apply'), [0])
+
+    def testApplyAll(self):
+        res = self.app.get('/_ah/migration/tasks/migrate/?action=apply&all=1')
+        self.assertEqual(res.status_int, 302)
+        self.submit_deferred()
+        self.assertTrue(all(m.isapplied() for m in self.migrations))
+        self.assertEqual(migrate.MigrationLease.query().count(), 0)
+
+    def testAdminPage(self):
+        total = len(self.migrations)
+        self.migrations[0].apply()
+        app = self.migrations[0].application
+        page = self.app.get('/_ah/migration/?app=%s' % app)
+        self.assertContains(page, '%s migrations, page 1 of 1' % total)
+        page = self.app.get('/_ah/migration/?status=apply+success&app=%s' % app)
+        self.assertContains(page, '1 migrations, page 1 of 1')
+        self.assertContains(page, self.migrations[0].id)
+        self.assertFalse(self.migrations[1].id in page.body)
+        # out of range pages show the last page
+        page = self.app.get('/_ah/migration/?status=new&page=10&app=%s' % app)
+        self.assertContains(page, '%s migrations, page 1 of 1' % (total - 1))
+
+    def testBatchedApply(self):
+        target_migration = self.migrations[3]
+        self.app.get('/_ah/migration/tasks/migrate/?%s' % self.migrations.url_query_for('apply', target_migration))
+        tasks = self.get_tasks()
+        self.assertEqual(len(tasks), 1)
+        self.testbed.get_stub("taskqueue").FlushQueue("default")
+        self.app.post(tasks[0]["url"], tasks[0]["body"].decode('base64'))
+        # all migrations are applied by a single task
+        self.assertEqual(len(self.get_tasks()), 0)
+        self.assertEqual(len(self.migrations.to_apply()), 0)
+
+    def testProfile(self):
+        target_migration = self.migrations[3]
+        self.app.get('/_ah/migration/tasks/migrate/?%s&profile=1' % self.migrations.url_query_for('apply', target_migration))
+        self.submit_deferred()
+        # every migration run in the profiled chain has a profile
+        entry = target_migration.key.get()
+        self.assertEqual(entry.profiles, 1)
+        listing = self.app.get('/_ah/migration/profile/?app=%s&id=%s' % (target_migration.application,
+                                                                        target_migration.id))
+        url = listing.body.splitlines()[0]
+        self.assertContains(self.app.get(url), '_process_steps')
+        stats = self.app.get(url + '&format=pstats')
+        self.assertEqual(stats.content_type, 'application/octet-stream')
+        self.app.get(url + '&top=all', status=400)
+        self.app.get(url + '&sort=nonsense', status=400)
+        self.app.get(url.rsplit('=', 1)[0] + '=x', status=400)
+        # profiles of a rollback are counted on its run, the entry is removed by then
+        target_migration.profile = True
+        target_migration.rollback()
+        self.assertEqual(target_migration.key.get(), None)
+        run = migrate.MigrationRun.key_for(target_migration.key, 'rollback').get()
+        self.assertEqual(run.profiles, 2)
+        self.assertContains(self.app.get('/_ah/migration/'), 'Profiles (2)')
+        # the newest profile is listed first
+        listing = self.app.get('/_ah/migration/profile/?app=%s&id=%s' % (target_migration.application,
+                                                                        target_migration.id))
+        newest = max(migrate.MigrationProfile.query(ancestor=target_migration.key), key=lambda p: p.created)
+        self.assertEqual(newest.direction, 'rollback')
+        self.assertEqual(len(listing.body.splitlines()), 2)
+        self.assertTrue(listing.body.splitlines()[0].endswith('profile=%s' % newest.key.id()))
 
     def testFullRollback(self):
         self.testApply()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Migration throughput benchmarks on the local testbed stubs.
+
+Run with::
+
+    python -m zojax.gae.migration.tests.benchmark --sizes 1000,10000 --entity-sizes 100,10000 \\
+        --output bench.json [--baseline previous.json --tolerance 0.2]
+
+Every dataset is migrated through the same scenarios (property add, transform,
+
+transform rollback, delete). The report lists entities/second, datastore RPCs
+
+per entity and the memory the process grew by while running every scenario.
+"""
+
+import sys
+import json
+import time
+import platform
+import resource
+import optparse
+import threading
+
+from ndb import model
+
+from .. import migrate
+from ..mapper import Mapper
+from ..stats import Recorder
+
+
+class BenchmarkEntity(model.Model):
+    payload = model.TextProperty()
+    counter = model.IntegerProperty()
+    flag = model.BooleanProperty()
+
+
+def populate(entities, entity_size, batch_size=500):
+    """
+    Puts ``entities`` BenchmarkEntity objects with ``entity_size`` bytes of payload.
+    """
+    payload = "x" * entity_size
+    for start in range(0, entities, batch_size):
+        model.put_multi([BenchmarkEntity(payload=payload, counter=i)
+                         for i in range(start, min(start + batch_size, entities))])
+
+
+def add_property(entity):
+    entity.flag = True
+    return entity
+
+
+def transform(entity):
+    entity.counter *= 2
+    entity.payload = entity.payload.upper()
+    return entity
+
+
+def untransform(entity):
+    entity.counter //= 2
+    entity.payload = entity.payload.lower()
+    return entity
+
+
+def delete(entity):
+    return entity.key
+
+
+# scenarios run in this order over every dataset
+SCENARIOS = [
+    ('add_property', 'apply', add_property, None),
+    ('transform', 'apply', transform, untransform),
+    ('rollback', 'rollback', transform, untransform),
+    ('delete', 'apply', delete, None),
+]
+
+
+def memory_kb():
+    """
+    Returns the resident memory of the process in KB, None where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class MemorySampler(object):
+    """
+    Samples the resident memory every ``interval`` seconds in a thread while
+
+    entered. ``growth_kb`` is the peak above the memory at entering, unlike
+
+    ru_maxrss it is not carried over from earlier scenarios.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        current = memory_kb()
+        if current is not None and (self.peak is None or current > self.peak):
+            self.peak = current
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start = self.peak = memory_kb()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.sample()
+
+    @property
+    def growth_kb(self):
+        if self.start is None:
+            return None
+        return self.peak - self.start
+
+
+def make_migration(name, fn, rollback, batch_size):
+    step = migrate.MigrationStep(0,
+                                 Mapper(BenchmarkEntity.query(), fn, batch_size),
+                                 Mapper(BenchmarkEntity.query(), rollback, batch_size) if rollback else None)
+    return migrate.Migration(name, [migrate.Transaction([step], fake_transaction=True)], '',
+                             application='benchmark')
+
+
+def run_benchmarks(sizes, entity_sizes, batch_size=100):
+    """
+    Runs all scenarios for every dataset. Expects the datastore and
+
+    memcache stubs to be active. Returns a list of results.
+    """
+    results = []
+    for entities in sizes:
+        for entity_size in entity_sizes:
+            populate(entities, entity_size)
+            for name, direction, fn, rollback in SCENARIOS:
+                if direction == 'rollback':
+                    migration = make_migration('transform', fn, rollback, batch_size)
+                else:
+                    migration = make_migration(name, fn, rollback, batch_size)
+                with MemorySampler() as memory:
+                    with Recorder() as recorder:
+                        getattr(migration, direction)()
+                results.append({
+                    'scenario': name,
+                    'entities': entities,
+                    'entity_size': entity_size,
+                    'batch_size': batch_size,
+                    'duration': recorder.duration,
+                    'entities_per_second': entities / recorder.duration if recorder.duration else None,
+                    'rpcs': recorder.rpcs,
+                    'rpcs_per_entity': float(recorder.rpcs) / entities if entities else None,
+                    'reads': recorder.reads,
+                    'writes': recorder.writes,
+                    'memory_kb': memory.growth_kb,
+                })
+            # the delete scenario leaves only the migration entries
+            model.delete_multi(migrate.MigrationEntry.query().fetch(keys_only=True))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns descriptions of results whose throughput is more than
+
+    ``tolerance`` (a fraction) lower than in ``baseline``.
+    """
+    known = dict(((r['scenario'], r['entities'], r['entity_size']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        previous = known.get((result['scenario'], result['entities'], result['entity_size']))
+        if not previous or not previous['entities_per_second'] or not result['entities_per_second']:
+            continue
+        ratio = result['entities_per_second'] / previous['entities_per_second']
+        if ratio < 1 - tolerance:
+            regressions.append("%(scenario)s of %(entities)d entities of %(entity_size)d bytes" % result +
+                               ": %.1f entities/s, was %.1f" % (result['entities_per_second'],
+                                                                previous['entities_per_second']))
+    return regressions
+
+
+def setup_testbed():
+    from google.appengine.ext import testbed
+    from google.appengine.datastore import datastore_stub_util
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='benchmark')
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    return bed
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="1000,10000",
+                      help="comma separated numbers of entities [%default]")
+    parser.add_option("--entity-sizes", default="100,10000",
+                      help="comma separated payload sizes in bytes [%default]")
+    parser.add_option("--batch-size", type="int", default=100,
+                      help="map_step batch size [%default]")
+    parser.add_option("--output", help="file to write the JSON report to, stdout by default")
+    parser.add_option("--baseline", help="JSON report of a previous version to compare with")
+    parser.add_option("--tolerance", type="float", default=0.2,
+                      help="allowed throughput drop against the baseline [%default]")
+    options, args = parser.parse_args(argv)
+
+    bed = setup_testbed()
+    try:
+        results = run_benchmarks([int(size) for size in options.sizes.split(",")],
+                                 [int(size) for size in options.entity_sizes.split(",")],
+                                 options.batch_size)
+    finally:
+        bed.deactivate()
+
+    report = json.dumps({'python': platform.python_version(),
+                         'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                         'results': results,
+                         }, indent=2)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report)
+    else:
+        print report
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], options.tolerance)
+        for regression in regressions:
+            sys.stderr.write("Regression: %s\n" % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,31 @@
 import sys
 import os
-#import termios
-
-#def getch():
-#    """
-#    Read a single character without echoing to the console and without having
-#    to wait for a newline.
-#    """
-#    fd = sys.stdin.fileno()
-#    saved_attributes = termios.tcgetattr(fd)
-#    try:
-#        attributes = termios.tcgetattr(fd) # get a fresh copy!
-#        attributes[3] = attributes[3] & ~(termios.ICANON | termios.ECHO)
-#        attributes[6][termios.VMIN] = 1
-#        attributes[6][termios.VTIME] = 0
-#        termios.tcsetattr(fd, termios.TCSANOW, attributes)
-#
-#        a = sys.stdin.read(1)
-#    finally:
-#        #be sure to reset the attributes no matter what!
-#        termios.tcsetattr(fd, termios.TCSANOW, saved_attributes)
-#    return a
+
+
+def getch():
+    """
+    Read a single character without echoing to the console and without having
+    to wait for a newline. Reads a line when stdin is not a terminal.
+    """
+    if not sys.stdin.isatty():
+        return (sys.stdin.readline() or '\n')[0]
+    # not available in the App Engine sandbox
+    import termios
+
+    fd = sys.stdin.fileno()
+    saved_attributes = termios.tcgetattr(fd)
+    try:
+        attributes = termios.tcgetattr(fd) # get a fresh copy!
+        attributes[3] = attributes[3] & ~(termios.ICANON | termios.ECHO)
+        attributes[6][termios.VMIN] = 1
+        attributes[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+
+        a = sys.stdin.read(1)
+    finally:
+        #be sure to reset the attributes no matter what!
+        termios.tcsetattr(fd, termios.TCSANOW, saved_attributes)
+    return a
 
 def prompt(prompt, options):
     """